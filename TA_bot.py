@@ -1,75 +1,82 @@
-import requests
-from flask import Flask, request, jsonify
-from llmproxy import generate
 import os
+from flask import Flask, request, jsonify
+from llmproxy import generate, generate_stream, is_error, response_text
+from resilience import DEGRADED_TEXT
+import tracing
+from jobqueue import enqueue_reply, BUSY_TEXT
+from rocketchat import stream_reply, update_message
+from search import google_search
+from alg_classifier import is_algorithm_question
+import conversation
+import prompts
 
 app = Flask(__name__)
+tracing.install(app)
 
-def google_search(query, site_filter="youtube.com"):
-    """Queries Google Search API and returns the first YouTube result link."""
-    search_url = "https://www.googleapis.com/customsearch/v1"
-    
-    params = {
-        "key": os.environ.get("GOOGLE_API_KEY"),
-        "cx": os.environ.get("GOOGLE_CSE_ID"),
-        "q": query,
-        "num": 1
-    }
-    
-    if site_filter:
-        params["q"] += f" site:{site_filter}"
-    
-    response = requests.get(search_url, params=params)
-    
-    if response.status_code == 200:
-        search_results = response.json().get("items", [])
-        if search_results:
-            return search_results[0]["link"]
-    print(f"Error: {response.status_code}, {response.text}")
-    return None
+# Post the reply early and edit it as tokens arrive instead of waiting for the full answer
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "0") == "1"
 
-@app.route('/', methods=['POST'])
-def handle_request():
-    data = request.get_json()
+# Answer webhooks immediately and deliver replies through the Rocket.Chat API
+ASYNC_REPLIES = os.environ.get("ASYNC_REPLIES", "0") == "1"
+
+def build_reply(data):
+    """Build the reply for one Rocket.Chat webhook payload."""
     user = data.get("user_name", "Unknown")
     message = data.get("text", "")
+    room_id = data.get("channel_id", "")
 
     # Ignore bot messages
     if data.get("bot") or not message:
-        return jsonify({"status": "ignored"})
+        return {"status": "ignored"}
 
     print(f"Message from {user}: {message}")
 
     # Socratic TA Agent — gently guides
-    response = generate(
+    # History is kept per bot, since the router serves every persona from one process
+    history_key = f"ta:{user}"
+    query, lastk = conversation.prepare(history_key, message, lastk=5)
+    main_call = dict(
         model='4o-mini',
-        system=(
-            "You are a helpful teaching assistant in a university class. "
-            "Your goal is to guide students to discover answers on their own rather than providing direct answers. "
-            "Ask follow-up questions that help them think critically. "
-            "If the student asks about an algorithm or programming concept, check if they need further resources, "
-            "such as a YouTube video tutorial. Be encouraging and supportive, and never dismissive. "
-            "If the question is unrelated to an algorithms or data structures class, gently remind them of your purpose."
-        ),
-        query=f"{message}",
+        task="converse",
+        system=prompts.text("ta_socratic"),
+        query=query,
         temperature=0.5,
-        lastk=5,
+        lastk=lastk,
         session_id=user
     )
 
-    ta_reply = response["response"]
+    streamed_message = None
+    if STREAM_REPLIES and room_id:
+        ta_reply, streamed_message = stream_reply(room_id, generate_stream(**main_call))
+        if is_error(ta_reply):
+            ta_reply = None
+    else:
+        ta_reply = response_text(generate(**main_call))
+
+    # Model unreachable: answer right away instead of classifying and searching
+    if ta_reply is None:
+        if streamed_message:
+            update_message(streamed_message["rid"], streamed_message["_id"], DEGRADED_TEXT)
+            return {"status": "streamed"}
+        return {"text": DEGRADED_TEXT}
+    conversation.record(history_key, message, ta_reply)
 
     # Check if this is an algorithm-related query
-    keyword_check = generate(
-        model="4o-mini",
-        system="Identify whether this question is about a specific computer science algorithm or concept. Respond with 'yes' or 'no'.",
-        query=message,
-        temperature=0.0,
-        lastk=0,
-        session_id=user + "_alg_check"
-    )
+    def llm_algorithm_check():
+        keyword_check = generate(
+            model="4o-mini",
+            task="classify",
+            system=prompts.text("ta_algorithm_check"),
+            query=message,
+            temperature=0.0,
+            lastk=0,
+            near_duplicate=message,
+            session_id=user + "_alg_check"
+        )
+        # No video link if the check itself fails
+        return (response_text(keyword_check) or "").strip().lower() == "yes"
 
-    is_algorithm = keyword_check["response"].strip().lower() == "yes"
+    is_algorithm = is_algorithm_question(message, fallback=llm_algorithm_check)
 
     final_text = ta_reply
 
@@ -111,7 +118,22 @@ def handle_request():
         ]
     }
 
-    return jsonify(response_with_buttons)
+    if streamed_message:
+        update_message(streamed_message["rid"], streamed_message["_id"],
+                       final_text, response_with_buttons["attachments"])
+        return {"status": "streamed"}
+
+    return response_with_buttons
+
+@app.route('/', methods=['POST'])
+def handle_request():
+    data = request.get_json()
+    # Acknowledge right away and post the answer from a background worker
+    if ASYNC_REPLIES and data.get("channel_id") and not data.get("bot"):
+        if not enqueue_reply(build_reply, data):
+            return jsonify({"text": BUSY_TEXT})
+        return jsonify({"status": "queued"})
+    return jsonify(build_reply(data))
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -1,144 +1,129 @@
 import os
-import requests
 from flask import Flask, request, jsonify
-from llmproxy import generate, pdf_upload, text_upload, retrieve
-from string import Template
-
-# Rocket.Chat settings
-ROCKET_CHAT_URL = os.environ.get("RC_URL", "https://chat.genaiconnect.net")
-ROCKET_USER_ID = os.environ.get("RCuser")
-ROCKET_AUTH_TOKEN = os.environ.get("RCtoken")
-
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-ALLOWED_EXTENSIONS = {'txt', 'pdf'}
+from llmproxy import generate, generate_stream, is_error, response_text
+from resilience import DEGRADED_TEXT
+from retrieval import prefetch
+import fanout
+import tracing
+from jobqueue import enqueue_reply, submit, BUSY_TEXT
+from ingest import ingest_files
+from rocketchat import stream_reply, update_message
+from search import google_search
+from alg_classifier import is_algorithm_question
+import conversation
+import prompts
+from rag_context import build_context
+
+# Post the reply early and edit it as tokens arrive instead of waiting for the full answer
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "0") == "1"
+
+# Answer webhooks immediately and deliver replies through the Rocket.Chat API
+ASYNC_REPLIES = os.environ.get("ASYNC_REPLIES", "0") == "1"
 
 app = Flask(__name__)
+tracing.install(app)
+
+def rag_context_string_simple(rag_context, model=None):
+    return build_context(
+        rag_context,
+        model=model,
+        header="Here is some context from your uploaded files:\n",
+        doc_format="\n#{i} {summary}\n",
+        chunk_format="#{i}.{j} {chunk}\n"
+    )
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def download_file(file_id, filename):
-    """Download file from Rocket.Chat and save locally."""
-    if allowed_file(filename):
-        file_url = f"{ROCKET_CHAT_URL}/file-upload/{file_id}/{filename}"
-        headers = {
-            "X-User-Id": ROCKET_USER_ID,
-            "X-Auth-Token": ROCKET_AUTH_TOKEN
-        }
-        response = requests.get(file_url, headers=headers, stream=True)
-        if response.status_code == 200:
-            local_path = os.path.join(UPLOAD_FOLDER, filename)
-            with open(local_path, "wb") as f:
-                for chunk in response.iter_content(8192):
-                    f.write(chunk)
-            return local_path
-    print(f"Download error {filename} - {response.status_code}")
-    return None
-
-def rag_context_string_simple(rag_context):
-    context_string = ""
-    i = 1
-    for collection in rag_context:
-        if not context_string:
-            context_string = "Here is some context from your uploaded files:\n"
-        context_string += f"\n#{i} {collection['doc_summary']}\n"
-        for j, chunk in enumerate(collection['chunks'], start=1):
-            context_string += f"#{i}.{j} {chunk}\n"
-        i += 1
-    return context_string
-
-def google_search(query, site_filter="youtube.com"):
-    """Queries Google Search API and returns the first YouTube result link."""
-    search_url = "https://www.googleapis.com/customsearch/v1"
-    params = {
-        "key": os.environ.get("GOOGLE_API_KEY"),
-        "cx": os.environ.get("GOOGLE_CSE_ID"),
-        "q": f"{query} site:{site_filter}",
-        "num": 1
-    }
-    response = requests.get(search_url, params=params)
-    if response.status_code == 200:
-        results = response.json().get("items", [])
-        if results:
-            return results[0]["link"]
-    print(f"Search error: {response.status_code}, {response.text}")
-    return None
-
-@app.route("/", methods=["POST"])
-def handle_request():
-    data = request.get_json()
+def build_reply(data):
+    """Build the reply for one Rocket.Chat webhook payload."""
     user = data.get("user_name", "Unknown")
     message = data.get("text", "")
     room_id = data.get("channel_id", "")
 
     # Ignore bot messages
     if data.get("bot") or (not message and "files" not in data.get("message", {})):
-        return jsonify({"status": "ignored"})
+        return {"status": "ignored"}
 
     # Handle file uploads
     if "files" in data.get("message", {}):
-        saved_files = []
-        for file_info in data["message"]["files"]:
-            file_id = file_info["_id"]
-            filename = file_info["name"]
-            local_path = download_file(file_id, filename)
-            if local_path:
-                # Upload to LLMProxy
-                if filename.endswith(".pdf"):
-                    pdf_upload(path=local_path, session_id=user, strategy="smart")
-                elif filename.endswith(".txt"):
-                    with open(local_path, "r") as f:
-                        text_upload(text=f.read(), session_id=user, strategy="smart")
-                saved_files.append(filename)
+        files = data["message"]["files"]
+        # Ingest off the request thread and report per-file progress in the room
+        if room_id and submit(ingest_files, files, user, room_id):
+            return {"text": "📥 Got your file(s). I'll post their progress here as they're added."}
+        saved_files = ingest_files(files, user)
 
         file_list = "\n".join(f"- {f}" for f in saved_files)
-        return jsonify({
+        return {
             "text": f"✅ File(s) uploaded successfully:\n{file_list}\n\nWhat would you like help with in the file?"
-        })
+        }
 
     # Otherwise, handle normal user query
-    # Retrieve RAG context (if any files uploaded before)
-    rag_context = retrieve(query=message, session_id=user, rag_threshold=0.2, rag_k=3)
-    context_str = rag_context_string_simple(rag_context)
-
-    full_prompt = Template("$query\n\n$rag_context").substitute(
-        query=message,
-        rag_context=context_str
-    )
+    # Retrieve RAG context (if any files uploaded before) in the background
+    rag_future = prefetch(query=message, session_id=user, rag_threshold=0.2, rag_k=3)
+
+    # Meanwhile check if it’s an algorithm question and look for a video if so
+    def llm_algorithm_check():
+        alg_check = generate(
+            model="4o-mini",
+            task="classify",
+            system=prompts.text("ta2_algorithm_check"),
+            query=message,
+            temperature=0.0,
+            lastk=0,
+            near_duplicate=message,
+            session_id=user + "_alg_check"
+        )
+        # No video link if the check itself fails
+        return (response_text(alg_check) or "").strip().lower() == "yes"
+
+    def find_video():
+        if is_algorithm_question(message, fallback=llm_algorithm_check):
+            return google_search(message, site_filter="youtube.com")
+        return None
+
+    video_future = fanout.submit(find_video)
+
+    rag_context = rag_future.result()
+    context_str = rag_context_string_simple(rag_context, model="4o-mini")
+
+    full_prompt = prompts.render("rag_query", query=message, rag_context=context_str)
 
     # Generate thoughtful TA response
-    ta_response = generate(
+    # History is kept per bot, since the router serves every persona from one process
+    history_key = f"ta2:{user}"
+    query, lastk = conversation.prepare(history_key, full_prompt, lastk=5)
+    main_call = dict(
         model="4o-mini",
-        system=(
-            "You are a helpful TA for an algorithms and data structures class. "
-            "Use uploaded content to help the student, but don't just give away answers. "
-            "Ask clarifying or guiding questions. Include video resources if the query is algorithm-related."
-        ),
-        query=full_prompt,
+        task="converse",
+        system=prompts.text("ta2_tutor"),
+        query=query,
         temperature=0.4,
-        lastk=5,
+        lastk=lastk,
         session_id=user,
         rag_usage=False
     )
 
-    answer = ta_response["response"]
-
-    # Check if it’s an algorithm question and attach video if so
-    alg_check = generate(
-        model="4o-mini",
-        system="Is this about an algorithm or data structure? Reply 'yes' or 'no'.",
-        query=message,
-        temperature=0.0,
-        lastk=0,
-        session_id=user + "_alg_check"
-    )
-    if alg_check["response"].strip().lower() == "yes":
-        link = google_search(message)
-        if link:
-            answer += f"\n\n🔗 You might also find this helpful: {link}"
-
-    return jsonify({
+    streamed_message = None
+    if STREAM_REPLIES and room_id:
+        answer, streamed_message = stream_reply(room_id, generate_stream(**main_call))
+        if is_error(answer):
+            answer = None
+    else:
+        answer = response_text(generate(**main_call))
+
+    # Model unreachable: reply right away without waiting on the video lookup
+    if answer is None:
+        video_future.cancel()
+        if streamed_message:
+            update_message(streamed_message["rid"], streamed_message["_id"], DEGRADED_TEXT)
+            return {"status": "streamed"}
+        return {"text": DEGRADED_TEXT}
+    conversation.record(history_key, message, answer)
+
+    # Attach the video found alongside the answer
+    link = video_future.result()
+    if link:
+        answer += f"\n\n🔗 You might also find this helpful: {link}"
+
+    reply = {
         "text": answer,
         "attachments": [
             {
@@ -168,7 +153,24 @@ def handle_request():
                 ]
             }
         ]
-    })
+    }
+
+    if streamed_message:
+        update_message(streamed_message["rid"], streamed_message["_id"],
+                       answer, reply["attachments"])
+        return {"status": "streamed"}
+
+    return reply
+
+@app.route("/", methods=["POST"])
+def handle_request():
+    data = request.get_json()
+    # Acknowledge right away and post the answer from a background worker
+    if ASYNC_REPLIES and data.get("channel_id") and not data.get("bot"):
+        if not enqueue_reply(build_reply, data):
+            return jsonify({"text": BUSY_TEXT})
+        return jsonify({"status": "queued"})
+    return jsonify(build_reply(data))
 
 @app.errorhandler(404)
 def page_not_found(e):
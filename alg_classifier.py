@@ -0,0 +1,130 @@
+import os
+import re
+import math
+import threading
+import tracing
+
+# Local fast path for "is this message about an algorithm / data structure?".
+# Obvious cases are answered here; uncertain ones fall back to the LLM check.
+
+YES_THRESHOLD = float(os.environ.get("ALG_CLASSIFIER_YES", "0.8"))
+NO_THRESHOLD = float(os.environ.get("ALG_CLASSIFIER_NO", "0.2"))
+
+STRONG_TERMS = [
+    # named algorithms
+    "dijkstra", "bellman ford", "floyd warshall", "kruskal", "prim", "prims",
+    "a star", "a*", "quicksort", "quick sort", "mergesort", "merge sort",
+    "heapsort", "heap sort", "insertion sort", "selection sort", "bubble sort",
+    "radix sort", "counting sort", "bucket sort", "topological sort",
+    "binary search", "breadth first search", "depth first search", "bfs", "dfs",
+    "kmp", "knuth morris pratt", "rabin karp", "huffman", "ford fulkerson",
+    "edmonds karp", "max flow", "min cut", "minimum spanning tree", "mst",
+    "shortest path", "union find", "disjoint set", "tarjan", "kosaraju",
+    "strongly connected components", "karatsuba", "strassen", "fft",
+    "master theorem", "amortized analysis", "big o", "big theta", "big omega",
+    "dynamic programming", "memoization", "greedy algorithm", "divide and conquer",
+    "backtracking", "knapsack", "longest common subsequence", "edit distance",
+    "traveling salesman", "np complete", "np hard", "p vs np",
+    # data structures
+    "linked list", "doubly linked list", "hash table", "hash map", "hashmap",
+    "hash function", "binary tree", "binary search tree", "bst", "avl tree",
+    "red black tree", "b tree", "b+ tree", "trie", "segment tree", "fenwick tree",
+    "priority queue", "min heap", "max heap", "binary heap", "adjacency list",
+    "adjacency matrix", "skip list", "bloom filter",
+]
+
+WEAK_TERMS = [
+    "algorithm", "algorithms", "sort", "sorting", "search", "searching", "tree",
+    "trees", "graph", "graphs", "heap", "recursion", "recursive", "complexity",
+    "runtime", "time complexity", "space complexity", "asymptotic", "array",
+    "arrays", "pointer", "node", "nodes", "vertex", "vertices", "edge", "edges",
+    "invariant", "loop invariant", "induction", "hashing", "traversal",
+    "inorder", "preorder", "postorder", "pivot", "partition", "cycle", "path",
+    "stack", "queue", "deque", "reduction", "o(n)", "o(n log n)", "o(log n)",
+    "o(1)", "o(n^2)",
+]
+
+NEGATIVE_TERMS = [
+    "hi", "hello", "hey", "thanks", "thank you", "deadline", "due", "due date",
+    "extension", "office hours", "grade", "grades", "grading", "exam date",
+    "syllabus", "canvas", "gradescope", "late", "zoom", "room", "attendance",
+    "restart", "explain again", "examples",
+]
+
+STRONG_WEIGHT = 1.0
+WEAK_WEIGHT = 0.5
+NEGATIVE_WEIGHT = 0.5
+MAX_NGRAM = 4
+
+def _normalize(text):
+    text = text.lower().replace("-", " ").replace("'s", "")
+    return re.sub(r"\s+", " ", text).strip()
+
+def _build_index():
+    index = {}
+    for terms, weight in ((WEAK_TERMS, WEAK_WEIGHT), (STRONG_TERMS, STRONG_WEIGHT),
+                          (NEGATIVE_TERMS, -NEGATIVE_WEIGHT)):
+        for term in terms:
+            index[_normalize(term)] = weight
+    return index
+
+_index = _build_index()
+
+_stats_lock = threading.Lock()
+_stats = {"local_yes": 0, "local_no": 0, "fallback": 0}
+
+def _tokens(text):
+    return re.findall(r"[a-z0-9+*^()']+", _normalize(text))
+
+def score(message):
+    """Return (positive, negative) keyword weight found in the message."""
+    tokens = _tokens(message)
+    positive = 0.0
+    negative = 0.0
+    matched = set()
+    for n in range(MAX_NGRAM, 0, -1):
+        for i in range(len(tokens) - n + 1):
+            gram = " ".join(tokens[i:i + n])
+            weight = _index.get(gram)
+            if weight is None or gram in matched:
+                continue
+            matched.add(gram)
+            if weight > 0:
+                positive += weight
+            else:
+                negative -= weight
+    # Very short messages with no CS vocabulary are chit-chat
+    if positive == 0 and len(tokens) <= 3:
+        negative += NEGATIVE_WEIGHT
+    return positive, negative
+
+def classify(message):
+    """Return (label, confidence) where label is 'yes', 'no' or None when uncertain."""
+    positive, negative = score(message)
+    confidence = 1 / (1 + math.exp(-(3 * positive - 3 * negative - 1.2)))
+    if confidence >= YES_THRESHOLD:
+        return "yes", confidence
+    if confidence <= NO_THRESHOLD:
+        return "no", 1 - confidence
+    return None, confidence
+
+def is_algorithm_question(message, fallback):
+    """Classify locally, calling fallback() (the LLM check) only when uncertain."""
+    label, _ = classify(message)
+    if label is None:
+        with _stats_lock:
+            _stats["fallback"] += 1
+        return fallback()
+    with _stats_lock:
+        _stats["local_" + label] += 1
+    return label == "yes"
+
+def stats():
+    """How often the local classifier answered vs. fell back to the LLM."""
+    with _stats_lock:
+        result = dict(_stats)
+    total = sum(result.values())
+    result["fallback_ratio"] = result["fallback"] / total if total else 0.0
+    return result
+
+tracing.register_stats("alg_classifier", stats)
@@ -1,77 +1,42 @@
 import os
-import requests
 from flask import Flask, request, jsonify
-from llmproxy import generate, pdf_upload, text_upload, retrieve
-from string import Template
+from llmproxy import generate
+from retrieval import retrieve
+import tracing
+from jobqueue import enqueue_reply, submit, BUSY_TEXT
+from ingest import ingest_files
+from rag_context import build_context
+import prompts
 
-# Rocket.Chat credentials
-ROCKET_CHAT_URL = os.environ.get("RC_URL", "https://chat.genaiconnect.net")
-ROCKET_USER_ID = os.environ.get("RCuser")
-ROCKET_AUTH_TOKEN = os.environ.get("RCtoken")
-
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-ALLOWED_EXTENSIONS = {'txt', 'pdf'}
+# Answer webhooks immediately and deliver replies through the Rocket.Chat API
+ASYNC_REPLIES = os.environ.get("ASYNC_REPLIES", "0") == "1"
 
 app = Flask(__name__)
+tracing.install(app)
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def download_file(file_id, filename):
-    """Download file from Rocket.Chat and save locally."""
-    if allowed_file(filename):
-        file_url = f"{ROCKET_CHAT_URL}/file-upload/{file_id}/{filename}"
-        headers = {
-            "X-User-Id": ROCKET_USER_ID,
-            "X-Auth-Token": ROCKET_AUTH_TOKEN
-        }
-        response = requests.get(file_url, headers=headers, stream=True)
-        if response.status_code == 200:
-            local_path = os.path.join(UPLOAD_FOLDER, filename)
-            with open(local_path, "wb") as f:
-                for chunk in response.iter_content(8192):
-                    f.write(chunk)
-            return local_path
-    return None
-
-def rag_context_string(rag_context):
-    context = ""
-    for i, doc in enumerate(rag_context, 1):
-        context += f"\n#{i}: {doc['doc_summary']}\n"
-        for j, chunk in enumerate(doc['chunks'], 1):
-            context += f"- {chunk}\n"
-    return context
+def rag_context_string(rag_context, model=None):
+    return build_context(rag_context, model=model)
 
-@app.route("/", methods=["POST"])
-def handle_request():
-    data = request.get_json()
+def build_reply(data):
+    """Build the reply for one Rocket.Chat webhook payload."""
     user = data.get("user_name", "Unknown")
     message = data.get("text", "")
     room_id = data.get("channel_id", "")
 
     # Handle file upload
     if "files" in data.get("message", {}):
-        for file_info in data["message"]["files"]:
-            file_id = file_info["_id"]
-            filename = file_info["name"]
-            local_path = download_file(file_id, filename)
-            if local_path:
-                if filename.endswith(".pdf"):
-                    pdf_upload(path=local_path, session_id=user, strategy="smart")
-                elif filename.endswith(".txt"):
-                    with open(local_path, "r") as f:
-                        text_upload(text=f.read(), session_id=user, strategy="smart")
-        return jsonify({"text": "✅ File uploaded. What would you like to ask about it?"})
+        files = data["message"]["files"]
+        # Ingest off the request thread and report per-file progress in the room
+        if room_id and submit(ingest_files, files, user, room_id):
+            return {"text": "📥 Got your file(s). I'll post their progress here as they're added."}
+        ingest_files(files, user)
+        return {"text": "✅ File uploaded. What would you like to ask about it?"}
 
     # Handle question
     if message and not data.get("bot"):
         rag_context = retrieve(query=message, session_id=user, rag_threshold=0.2, rag_k=3)
-        full_query = Template("$query\n\n$rag").substitute(
-            query=message,
-            rag=rag_context_string(rag_context)
-        )
-        return jsonify({"text": rag_context})
+        full_query = prompts.render("rag_query", query=message, rag_context=rag_context_string(rag_context))
+        return {"text": rag_context}
         # response = generate(
         #     model="4o-mini",
         #     system="You are a helpful teaching assistant. Use the context to help answer the question.",
@@ -81,9 +46,19 @@ def handle_request():
         #     session_id=user,
         #     rag_usage=False
         # )
-        # return jsonify({"text": response["response"]})
+        # return {"text": response["response"]}
+
+    return {"status": "ignored"}
 
-    return jsonify({"status": "ignored"})
+@app.route("/", methods=["POST"])
+def handle_request():
+    data = request.get_json()
+    # Acknowledge right away and post the answer from a background worker
+    if ASYNC_REPLIES and data.get("channel_id") and not data.get("bot"):
+        if not enqueue_reply(build_reply, data):
+            return jsonify({"text": BUSY_TEXT})
+        return jsonify({"status": "queued"})
+    return jsonify(build_reply(data))
 
 @app.errorhandler(404)
 def not_found(e):
@@ -0,0 +1,192 @@
+"""Latency and throughput benchmark for the bots against local stubs.
+
+Starts the stub_servers stand-ins, runs each bot under gunicorn pointed at
+them, replays webhook payloads at each concurrency level and reports
+p50/p95/p99 latency, requests per second, failures and external calls per
+turn. Example:
+
+    python benchmark.py --bots TA_bot music_bot --concurrency 1 8 32 --requests 100
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import stub_servers
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Realistic webhook payloads per bot, replayed round-robin
+PAYLOADS = {
+    "app": [
+        {"user_name": "alex.kim", "text": "What does the syllabus say about late homework?", "channel_id": "room1"},
+        {"user_name": "sam.lee", "text": "Summarize the grading policy", "channel_id": "room2"},
+    ],
+    "TA_bot": [
+        {"user_name": "alex.kim", "text": "How does Dijkstra's algorithm work?", "channel_id": "room1"},
+        {"user_name": "sam.lee", "text": "Why is quicksort O(n log n) on average?", "channel_id": "room2"},
+        {"user_name": "jo.park", "text": "When is the homework due?", "channel_id": "room3"},
+        {"user_name": "alex.kim", "text": "explain again", "channel_id": "room1"},
+    ],
+    "TA_bot2": [
+        {"user_name": "alex.kim", "text": "How does a binary search tree stay balanced?", "channel_id": "room1"},
+        {"user_name": "sam.lee", "text": "Can you walk me through BFS on a graph?", "channel_id": "room2"},
+        {"user_name": "jo.park", "text": "examples", "channel_id": "room3"},
+    ],
+    "music_bot": [
+        {"user_name": "alex.kim", "text": "A rainy night confession between two old friends", "channel_id": "room1"},
+        {"user_name": "sam.lee", "text": "Dark abandoned cabin, something is whispering", "channel_id": "room2"},
+        {"user_name": "jo.park", "text": "3 songs please", "channel_id": "room3"},
+    ],
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def http(method, url, body=None, timeout=120):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, response.read()
+
+def start_bot(bot, port, env, workers, threads, workdir):
+    command = [
+        sys.executable, "-m", "gunicorn", f"{bot}:app",
+        "-b", f"127.0.0.1:{port}",
+        "--workers", str(workers),
+        "--threads", str(threads),
+        "--pythonpath", REPO_DIR,
+        "--log-level", "warning"
+    ]
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{bot} failed to start: {process.stderr.read().decode()}")
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{bot} did not start listening on port {port}")
+
+def stub_counts(servers):
+    counts = {}
+    for name, server in servers.items():
+        _, body = http("GET", f"http://127.0.0.1:{server.server_port}/_stats")
+        for kind, count in json.loads(body).items():
+            counts[f"{name}.{kind}"] = count
+    return counts
+
+def reset_stubs(servers):
+    for server in servers.values():
+        http("POST", f"http://127.0.0.1:{server.server_port}/_reset", {})
+
+def run_level(url, payloads, concurrency, total):
+    """Fire total requests with the given concurrency. Returns (latencies, failures, elapsed)."""
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status, _ = http("POST", url, payloads[i % len(payloads)])
+            ok = status == 200
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, ok in results if ok]
+    failures = sum(1 for _, ok in results if not ok)
+    return latencies, failures, elapsed
+
+def benchmark(args):
+    servers = {
+        "proxy": stub_servers.start_server(stub_servers.ProxyStubHandler, 0, args.proxy_latency, args.error_rate),
+        "google": stub_servers.start_server(stub_servers.GoogleStubHandler, 0, args.google_latency, args.error_rate),
+        "rocketchat": stub_servers.start_server(stub_servers.RocketChatStubHandler, 0, args.rc_latency, args.error_rate),
+    }
+    results = []
+    for bot in args.bots:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ)
+            env.update({
+                "endPoint": f"http://127.0.0.1:{servers['proxy'].server_port}/",
+                "apiKey": "benchmark",
+                "GOOGLE_SEARCH_URL": f"http://127.0.0.1:{servers['google'].server_port}/",
+                "RC_URL": f"http://127.0.0.1:{servers['rocketchat'].server_port}",
+                "PYTHONPATH": REPO_DIR,
+            })
+            port = free_port()
+            process = start_bot(bot, port, env, args.workers, args.threads, workdir)
+            try:
+                url = f"http://127.0.0.1:{port}/"
+                # Warm imports and connection pools so cold start doesn't skew the first level
+                run_level(url, PAYLOADS[bot], args.workers * args.threads, args.warmup)
+                for concurrency in args.concurrency:
+                    reset_stubs(servers)
+                    latencies, failures, elapsed = run_level(url, PAYLOADS[bot], concurrency, args.requests)
+                    counts = stub_counts(servers)
+                    turns = max(len(latencies) + failures, 1)
+                    row = {
+                        "bot": bot,
+                        "concurrency": concurrency,
+                        "requests": args.requests,
+                        "failures": failures,
+                        "rps": len(latencies) / elapsed if elapsed else 0.0,
+                        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+                        "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+                        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+                        "calls_per_turn": {kind: count / turns for kind, count in sorted(counts.items())},
+                    }
+                    results.append(row)
+                    print_row(row)
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    return results
+
+def print_row(row):
+    def ms(value):
+        return f"{value:8.1f}" if value is not None else "       -"
+    calls = ", ".join(f"{kind}={count:.2f}" for kind, count in row["calls_per_turn"].items())
+    print(f"{row['bot']:<10} c={row['concurrency']:<4} rps={row['rps']:7.2f} "
+          f"p50={ms(row['p50_ms'])} p95={ms(row['p95_ms'])} p99={ms(row['p99_ms'])} "
+          f"fail={row['failures']:<4} calls/turn: {calls}", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bots", nargs="+", default=list(PAYLOADS), choices=list(PAYLOADS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=50, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=8, help="unmeasured requests before the first level")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--proxy-latency", type=float, default=0.3)
+    parser.add_argument("--google-latency", type=float, default=0.15)
+    parser.add_argument("--rc-latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
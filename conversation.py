@@ -0,0 +1,197 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+import fanout
+import prompts
+import tracing
+from llmproxy import generate
+from rag_context import estimate_tokens
+
+# "local" keeps conversation history here and sends a bounded context with
+# each call; "proxy" keeps the old behaviour of letting the proxy replay lastk
+MODE = os.environ.get("CONVERSATION_MEMORY", "local")
+# Token budget for summary + recent turns prepended to each query
+HISTORY_TOKENS = int(os.environ.get("CONVERSATION_HISTORY_TOKENS", "800"))
+SUMMARY_TOKENS = int(os.environ.get("CONVERSATION_SUMMARY_TOKENS", "200"))
+# Turns kept verbatim; older ones are folded into the rolling summary once
+# KEEP_TURNS more have piled up, so a fold call comes every KEEP_TURNS turns
+KEEP_TURNS = int(os.environ.get("CONVERSATION_KEEP_TURNS", "4"))
+# Longest single message kept verbatim in the history (in tokens)
+TURN_TOKENS = int(os.environ.get("CONVERSATION_TURN_TOKENS", "300"))
+MAX_SESSIONS = int(os.environ.get("CONVERSATION_MAX_SESSIONS", "5000"))
+# Set to share history between gunicorn workers via SQLite
+STORE_PATH = os.environ.get("CONVERSATION_STORE_PATH", "")
+SUMMARY_MODEL = os.environ.get("CONVERSATION_SUMMARY_MODEL", "4o-mini")
+# Longest raw window the bots used to ask the proxy for, used to report savings
+RAW_WINDOW = 10
+
+_lock = threading.Lock()
+_sessions = OrderedDict()   # session_id -> state dict
+_folding = set()            # session ids with a summary update in flight
+_stats = {"calls": 0, "tokens_sent": 0, "tokens_raw": 0, "folds": 0, "fold_failures": 0}
+_db_initialized = False
+
+def _empty_state():
+    # turns: [[user, assistant], ...] oldest first; sizes: token counts of the
+    # last RAW_WINDOW turns, kept only to compare against a raw lastk replay
+    return {"summary": "", "turns": [], "sizes": []}
+
+def _connect():
+    global _db_initialized
+    conn = sqlite3.connect(STORE_PATH, timeout=10)
+    if not _db_initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS conversations (session_id TEXT PRIMARY KEY, state TEXT)")
+        conn.commit()
+        _db_initialized = True
+    return conn
+
+def _load(session_id):
+    # Caller holds _lock
+    if not STORE_PATH:
+        state = _sessions.get(session_id)
+        if state is None:
+            return _empty_state()
+        _sessions.move_to_end(session_id)
+        return state
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT state FROM conversations WHERE session_id = ?", (session_id,)).fetchone()
+    return json.loads(row[0]) if row else _empty_state()
+
+def _save(session_id, state):
+    # Caller holds _lock
+    if not STORE_PATH:
+        _sessions[session_id] = state
+        _sessions.move_to_end(session_id)
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+        return
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO conversations (session_id, state) VALUES (?, ?)",
+            (session_id, json.dumps(state))
+        )
+
+def _clip(text, tokens):
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " …"
+
+def _format_turns(turns):
+    return "\n".join(f"User: {u}\nAssistant: {a}" for u, a in turns)
+
+def _render(state, budget):
+    summary = _clip(state["summary"], SUMMARY_TOKENS)
+    remaining = budget - estimate_tokens(summary)
+    recent = []
+    # Newest turns first until the budget runs out
+    for user_text, reply in reversed(state["turns"]):
+        turn = (_clip(user_text, TURN_TOKENS), _clip(reply, TURN_TOKENS))
+        cost = estimate_tokens(turn[0]) + estimate_tokens(turn[1]) + 4
+        if cost > remaining:
+            break
+        recent.append(turn)
+        remaining -= cost
+    recent.reverse()
+
+    parts = []
+    if summary:
+        parts.append(f"Summary of the earlier conversation:\n{summary}")
+    if recent:
+        parts.append(f"Recent conversation:\n{_format_turns(recent)}")
+    return "\n\n".join(parts)
+
+def prepare(session_id, query, lastk):
+    """Return (query, lastk) for a model call in this session. In local mode
+    the query is prefixed with a bounded summary + recent turns and lastk is 0."""
+    if MODE != "local":
+        return query, lastk
+    with _lock:
+        state = _load(session_id)
+        history = _render(state, HISTORY_TOKENS)
+        _stats["calls"] += 1
+        _stats["tokens_sent"] += estimate_tokens(history)
+        _stats["tokens_raw"] += sum(state["sizes"][-lastk:]) if lastk else 0
+    if not history:
+        return query, 0
+    return prompts.render("conversation_query", history=history, query=query), 0
+
+def _fallback_summary(summary, turns):
+    # Keep the user's side of the folded turns when the model is unavailable
+    notes = " ".join(f"User said: {_clip(u, 40)}" for u, _ in turns)
+    text = f"{summary} {notes}".strip()
+    limit = SUMMARY_TOKENS * 4
+    return text[-limit:] if len(text) > limit else text
+
+def _fold(session_id, summary, turns):
+    system = prompts.text("conversation_summary")
+    query = prompts.render("conversation_summary_query", summary=summary or "(none)", exchanges=_format_turns(turns))
+    # Summary calls are part of what local history costs, so they count as sent
+    with _lock:
+        _stats["tokens_sent"] += estimate_tokens(system) + estimate_tokens(query)
+    try:
+        response = generate(
+            model=SUMMARY_MODEL,
+            system=system,
+            query=query,
+            temperature=0.0,
+            lastk=0,
+            session_id=session_id + "_summary"
+        )
+        if isinstance(response, dict):
+            new_summary = _clip(response["response"].strip(), SUMMARY_TOKENS)
+        else:
+            with _lock:
+                _stats["fold_failures"] += 1
+            new_summary = _fallback_summary(summary, turns)
+
+        with _lock:
+            state = _load(session_id)
+            # Only drop the turns that were summarized; others may have arrived meanwhile
+            if state["turns"][:len(turns)] == [list(t) for t in turns]:
+                state["turns"] = state["turns"][len(turns):]
+                state["summary"] = new_summary
+                _save(session_id, state)
+            _stats["folds"] += 1
+    finally:
+        with _lock:
+            _folding.discard(session_id)
+
+def record(session_id, message, reply):
+    """Add one exchange to the session history. Once 2 * KEEP_TURNS turns are
+    held, all but the newest KEEP_TURNS are folded into the summary in the background."""
+    if MODE != "local" or not message:
+        return
+    with _lock:
+        state = _load(session_id)
+        state["turns"].append([message, reply or ""])
+        state["sizes"] = (state["sizes"] + [estimate_tokens(message) + estimate_tokens(reply or "")])[-RAW_WINDOW:]
+        _save(session_id, state)
+        overflow = len(state["turns"]) - KEEP_TURNS
+        if overflow < KEEP_TURNS or session_id in _folding:
+            return
+        _folding.add(session_id)
+        summary, turns = state["summary"], [tuple(t) for t in state["turns"][:overflow]]
+    fanout.submit(_fold, session_id, summary, turns)
+
+def clear(session_id):
+    """Forget the history for one session."""
+    with _lock:
+        if not STORE_PATH:
+            _sessions.pop(session_id, None)
+            return
+        with closing(_connect()) as conn, conn:
+            conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["sessions"] = len(_sessions)
+    result["tokens_saved"] = max(result["tokens_raw"] - result["tokens_sent"], 0)
+    return result
+
+tracing.register_stats("conversation", stats)
@@ -0,0 +1,18 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared worker pool for running independent calls of one chat turn side by side
+MAX_WORKERS = int(os.environ.get("FANOUT_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="fanout")
+
+def submit(fn, *args, **kwargs):
+    """Start fn(*args, **kwargs) in the background and return its future.
+    The caller's context (e.g. the tracing request id) carries over."""
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, fn, *args, **kwargs)
+
+def gather(*futures, timeout: float | None = None):
+    """Wait for every future and return their results in the same order."""
+    return [future.result(timeout=timeout) for future in futures]
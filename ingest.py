@@ -0,0 +1,224 @@
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+import requests
+from llmproxy import stream_upload
+from rocketchat import open_download, post_message, update_message
+from fanout import submit, gather
+from retrieval import invalidate
+import local_index
+import tracing
+
+# File types we can index, with the content type the proxy expects for each
+CONTENT_TYPES = {'txt': "application/text", 'pdf': "application/pdf"}
+CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", str(64 * 1024)))
+
+# Uploads are stored by content hash; the index remembers which sessions already have them
+UPLOAD_FOLDER = "uploads"
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+INDEX_PATH = os.path.join(UPLOAD_FOLDER, "index.sqlite3")
+RETENTION_SECONDS = int(os.environ.get("UPLOAD_RETENTION_DAYS", "14")) * 24 * 3600
+MAX_STORE_BYTES = int(os.environ.get("UPLOAD_MAX_STORE_MB", "500")) * 1024 * 1024
+CLEANUP_INTERVAL = 3600
+
+_cleanup_lock = threading.Lock()
+_last_cleanup = 0.0
+
+STATUS_ICONS = {
+    "queued": "⏳",
+    "downloading": "⬇️",
+    "uploading": "⬆️",
+    "done": "✅",
+    "duplicate": "♻️",
+    "failed": "❌",
+    "skipped": "⚠️"
+}
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in CONTENT_TYPES
+
+def content_type(filename):
+    return CONTENT_TYPES[filename.rsplit('.', 1)[1].lower()]
+
+def _connect():
+    conn = sqlite3.connect(INDEX_PATH, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS ingested ("
+        "hash TEXT, session_id TEXT, filename TEXT, ingested_at REAL, "
+        "PRIMARY KEY (hash, session_id))"
+    )
+    return conn
+
+def already_ingested(digest, session_id):
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT ingested_at FROM ingested WHERE hash = ? AND session_id = ?",
+            (digest, session_id)
+        ).fetchone()
+    return row is not None and time.time() - row[0] <= RETENTION_SECONDS
+
+def mark_ingested(digest, session_id, filename):
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO ingested (hash, session_id, filename, ingested_at) VALUES (?, ?, ?, ?)",
+            (digest, session_id, filename, time.time())
+        )
+
+def store_download(response, filename):
+    """Write a download into uploads/ under its SHA-256, hashing as it streams.
+    Returns (digest, path)."""
+    extension = filename.rsplit('.', 1)[1].lower()
+    temp_path = os.path.join(UPLOAD_FOLDER, f".{uuid.uuid4().hex}.part")
+    sha256 = hashlib.sha256()
+    try:
+        with open(temp_path, "wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        path = os.path.join(UPLOAD_FOLDER, f"{digest}.{extension}")
+        # Same hash means same bytes, so an existing copy can simply be reused
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return digest, path
+
+def _read_chunks(path):
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+def cleanup_uploads(now=None):
+    """Delete stored uploads past the retention period, then the oldest ones
+    until the store fits in UPLOAD_MAX_STORE_MB."""
+    now = now or time.time()
+    files = []
+    for name in os.listdir(UPLOAD_FOLDER):
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if name.startswith(os.path.basename(INDEX_PATH)) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        # Leftover partial downloads older than an hour are abandoned
+        limit = CLEANUP_INTERVAL if name.endswith(".part") else RETENTION_SECONDS
+        if now - stat.st_mtime > limit:
+            os.remove(path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= MAX_STORE_BYTES:
+            break
+        os.remove(path)
+        total -= size
+
+    with closing(_connect()) as conn, conn:
+        conn.execute("DELETE FROM ingested WHERE ingested_at < ?", (now - RETENTION_SECONDS,))
+
+def _maybe_cleanup():
+    global _last_cleanup
+    with _cleanup_lock:
+        if time.time() - _last_cleanup < CLEANUP_INTERVAL:
+            return
+        _last_cleanup = time.time()
+    try:
+        cleanup_uploads()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Upload cleanup error: {e}")
+
+@tracing.traced("ingest.file", is_error=lambda ok: not ok)
+def ingest_file(file_id, filename, session_id, on_status=lambda status: None):
+    """Add one Rocket.Chat attachment to the session's documents, skipping files
+    the session already uploaded. Returns True if the document is available."""
+    if not allowed_file(filename):
+        on_status("skipped")
+        return False
+    try:
+        return _ingest(file_id, filename, session_id, on_status)
+    except (requests.exceptions.RequestException, OSError, sqlite3.Error) as e:
+        # e.g. the download broke off mid-stream or the disk is full; one
+        # file failing shouldn't stop the others or leave its status stale
+        print(f"Ingest error {filename} - {e!r}")
+        on_status("failed")
+        return False
+
+def _ingest(file_id, filename, session_id, on_status):
+    on_status("downloading")
+    response = open_download(file_id, filename)
+    if response is None:
+        on_status("failed")
+        return False
+
+    with response:
+        digest, path = store_download(response, filename)
+
+    if already_ingested(digest, session_id):
+        os.utime(path)
+        on_status("duplicate")
+        return True
+
+    # Index locally first so the document is searchable right away
+    if local_index.ENABLED:
+        try:
+            text = local_index.extract_text(path)
+            if text:
+                local_index.add_document(session_id, text, summary=filename)
+                invalidate(session_id)
+        except Exception as e:
+            print(f"Local index error {filename} - {e!r}")
+
+    on_status("uploading")
+    result = stream_upload(
+        _read_chunks(path),
+        content_type=content_type(filename),
+        length=os.path.getsize(path),
+        session_id=session_id,
+        strategy="smart"
+    )
+
+    ok = result.startswith("Successfully")
+    if ok:
+        mark_ingested(digest, session_id, filename)
+        invalidate(session_id)
+    else:
+        print(f"Upload error {filename} - {result}")
+    on_status("done" if ok else "failed")
+    return ok
+
+def _status_text(files, statuses):
+    lines = [f"{STATUS_ICONS[status]} {info['name']} — {status}" for info, status in zip(files, statuses)]
+    return "Adding your files:\n" + "\n".join(lines)
+
+def ingest_files(files, session_id, room_id=None):
+    """Ingest Rocket.Chat attachments concurrently, reporting progress in room_id
+    if given. Returns the names of the files that were added."""
+    statuses = ["queued"] * len(files)
+    lock = threading.Lock()
+    message = post_message(room_id, _status_text(files, statuses)) if room_id else None
+
+    def report(index, status):
+        with lock:
+            statuses[index] = status
+            if message:
+                update_message(message["rid"], message["_id"], _status_text(files, statuses))
+
+    futures = [
+        submit(ingest_file, info["_id"], info["name"], session_id,
+               on_status=lambda status, index=index: report(index, status))
+        for index, info in enumerate(files)
+    ]
+    results = gather(*futures)
+    _maybe_cleanup()
+
+    added = [info["name"] for info, ok in zip(files, results) if ok]
+    if message:
+        summary = _status_text(files, statuses)
+        if added:
+            summary += "\n\nWhat would you like help with in the file?"
+        update_message(message["rid"], message["_id"], summary)
+    return added
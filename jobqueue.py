@@ -0,0 +1,90 @@
+import os
+import time
+import queue
+import threading
+import contextvars
+from rocketchat import post_message
+import tracing
+
+# Bounded in-process work queue so webhooks can be acknowledged immediately
+QUEUE_SIZE = int(os.environ.get("ASYNC_QUEUE_SIZE", "100"))
+WORKERS = int(os.environ.get("ASYNC_WORKERS", "4"))
+
+BUSY_TEXT = "I'm answering a lot of questions right now. Please try again in a moment."
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_workers = []
+_workers_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "submitted": 0,
+    "rejected": 0,
+    "completed": 0,
+    "failed": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+def _worker():
+    while True:
+        enqueued_at, context, fn, args, kwargs = _queue.get()
+        wait = time.monotonic() - enqueued_at
+        with _stats_lock:
+            _stats["wait_seconds_total"] += wait
+            _stats["wait_seconds_max"] = max(_stats["wait_seconds_max"], wait)
+        try:
+            context.run(fn, *args, **kwargs)
+            outcome = "completed"
+        except Exception as e:
+            print(f"Background job failed: {e!r}")
+            outcome = "failed"
+        finally:
+            _queue.task_done()
+        with _stats_lock:
+            _stats[outcome] += 1
+
+def _ensure_workers():
+    # Started lazily so each gunicorn worker process gets its own threads after fork
+    if len(_workers) < WORKERS:
+        with _workers_lock:
+            while len(_workers) < WORKERS:
+                thread = threading.Thread(target=_worker, name=f"job-{len(_workers)}", daemon=True)
+                thread.start()
+                _workers.append(thread)
+
+def submit(fn, *args, **kwargs):
+    """Queue fn(*args, **kwargs) for a worker thread. Returns False if the queue is full."""
+    _ensure_workers()
+    try:
+        _queue.put_nowait((time.monotonic(), contextvars.copy_context(), fn, args, kwargs))
+    except queue.Full:
+        with _stats_lock:
+            _stats["rejected"] += 1
+        return False
+    with _stats_lock:
+        _stats["submitted"] += 1
+    return True
+
+def _build_and_post(build_reply, data):
+    reply = build_reply(data)
+    # Replies without text (ignored or already streamed) need no post
+    if reply.get("text"):
+        post_message(data["channel_id"], reply["text"], reply.get("attachments"))
+
+def enqueue_reply(build_reply, data):
+    """Run build_reply(data) in the background and post its result to the room."""
+    return submit(_build_and_post, build_reply, data)
+
+def stats():
+    """Queue depth, throughput counters and time jobs spent waiting for a worker."""
+    with _stats_lock:
+        result = dict(_stats)
+    started = result["completed"] + result["failed"]
+    result["depth"] = _queue.qsize()
+    result["capacity"] = QUEUE_SIZE
+    result["workers"] = len(_workers)
+    result["wait_seconds_avg"] = result["wait_seconds_total"] / started if started else 0.0
+    return result
+
+tracing.register_stats("jobqueue", stats)
@@ -1,11 +1,117 @@
 import os
 import json
+import time
+import uuid
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fanout
+import resilience
+import response_cache
+import routing
+import singleflight
+import tracing
 
 # Read proxy config from environment
 end_point = os.environ.get("endPoint")
 api_key = os.environ.get("apiKey")
 
+# Connection pool settings (shared by every call in this process). By default
+# the pool keeps one connection per gunicorn request thread (WEB_THREADS, see
+# the Procfile) plus one per fanout worker; calls beyond the pool size open a
+# fresh connection and throw it away afterwards
+POOL_SIZE = int(os.environ.get(
+    "LLMPROXY_POOL_SIZE", str(int(os.environ.get("WEB_THREADS", "16")) + fanout.MAX_WORKERS)
+))
+CONNECT_TIMEOUT = float(os.environ.get("LLMPROXY_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("LLMPROXY_READ_TIMEOUT", "60"))
+MAX_RETRIES = int(os.environ.get("LLMPROXY_MAX_RETRIES", "2"))
+RETRY_BACKOFF = float(os.environ.get("LLMPROXY_RETRY_BACKOFF", "0.5"))
+# Longest Retry-After we honour before retrying a 429/503
+MAX_RETRY_AFTER = float(os.environ.get("LLMPROXY_MAX_RETRY_AFTER", "10"))
+
+_session = None
+_upload_session = None
+_session_lock = threading.Lock()
+
+class _CappedRetry(Retry):
+    """Retry that waits as long as Retry-After asks, but never more than MAX_RETRY_AFTER."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+def _make_session(retry):
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE,
+        pool_maxsize=POOL_SIZE,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    """Return the process-wide keep-alive session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Only 429 and 503 are retried: the proxy refused the request
+                # rather than ran it, so a generate or add can't run twice
+                _session = _make_session(_CappedRetry(
+                    total=MAX_RETRIES,
+                    connect=MAX_RETRIES,
+                    read=0,
+                    status=MAX_RETRIES,
+                    backoff_factor=RETRY_BACKOFF,
+                    status_forcelist=(429, 503),
+                    allowed_methods=frozenset(["GET", "POST"]),
+                    raise_on_status=False
+                ))
+    return _session
+
+def _get_upload_session():
+    # Upload bodies are generators or open files that a retry can't replay
+    # (it would resend an empty or truncated document), so never retry them
+    global _upload_session
+    if _upload_session is None:
+        with _session_lock:
+            if _upload_session is None:
+                _upload_session = _make_session(Retry(total=0, raise_on_status=False))
+    return _upload_session
+
+def _post(session=None, **kwargs):
+    # Raises resilience.Unavailable (a RequestException) while the proxy is
+    # throttled or failing, so callers fail fast with their usual error value
+    response = resilience.send(
+        "llmproxy",
+        (session or get_session()).post,
+        end_point,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        **kwargs
+    )
+    body = response.request.body
+    tracing.annotate(
+        status_code=response.status_code,
+        bytes_out=len(body) if isinstance(body, (bytes, str)) else None,
+        bytes_in=int(response.headers.get('Content-Length') or 0)
+    )
+    return response
+
+def is_error(result):
+    """Whether a result from retrieve/generate/upload (or streamed text) is an error message."""
+    return isinstance(result, str) and result.startswith(("Error", "An error"))
+
+def response_text(result):
+    """The reply text of a generate() result, or None if the call failed."""
+    if isinstance(result, dict):
+        return result['response']
+    return None
+
+@tracing.traced("llmproxy.retrieve", is_error=is_error)
 def retrieve(
     query: str,
     session_id: str,
@@ -28,7 +134,7 @@ def retrieve(
     msg = None
 
     try:
-        response = requests.post(end_point, headers=headers, json=request)
+        response = _post(headers=headers, json=request)
 
         if response.status_code == 200:
             msg = json.loads(response.text)
@@ -38,6 +144,7 @@ def retrieve(
         msg = f"An error occurred: {e}"
     return msg  
 
+@tracing.traced("llmproxy.generate", is_error=is_error)
 def generate(
     model: str,
     system: str,
@@ -47,10 +154,47 @@ def generate(
     session_id: str | None = None,
     rag_threshold: float | None = 0.5,
     rag_usage: bool | None = False,
-    rag_k: int | None = 0
+    rag_k: int | None = 0,
+    cache: bool | None = None,
+    task: str | None = None,
+    near_duplicate: str | None = None
     ):
-    
+    """Call the model. Deterministic, history-free calls (temperature 0, no
+    lastk, no RAG) are answered from response_cache when possible; pass
+    cache=True/False to force caching on or off. near_duplicate is the
+    variable part of the query (e.g. the student's question); when given,
+    a cached answer to a near-identical one may be reused. Concurrent identical
+    history-free calls share one upstream request. With a task class
+    ("classify", "extract", "converse") the model is chosen by routing and
+    model is only the default."""
+
+    if task:
+        model = routing.pick(task, model)
+        tracing.annotate(model=model, task=task)
+
+    history_free = not lastk and not rag_usage
+    if cache is None:
+        cache = temperature == 0.0 and history_free
+
+    cache_key = None
+    if cache:
+        cache_key = response_cache.make_key(model, system, query, temperature=temperature)
+        cached = response_cache.get(cache_key, model=model, system=system, similar_text=near_duplicate)
+        tracing.annotate(cache="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
 
+    args = (model, system, query, temperature, lastk, session_id,
+            rag_threshold, rag_usage, rag_k, cache_key, task, near_duplicate)
+    if history_free:
+        # The session id only matters for history, so callers from different
+        # sessions asking the same thing can share the call
+        flight_key = cache_key or response_cache.make_key(model, system, query, temperature=temperature)
+        return singleflight.do("llm", flight_key, _generate, *args)
+    return _generate(*args)
+
+def _generate(model, system, query, temperature, lastk, session_id,
+              rag_threshold, rag_usage, rag_k, cache_key, task, near_duplicate):
     headers = {
         'x-api-key': api_key,
         'request_type': 'call'
@@ -71,11 +215,15 @@ def generate(
     msg = None
 
     try:
-        response = requests.post(end_point, headers=headers, json=request)
+        started = time.perf_counter()
+        response = _post(headers=headers, json=request)
 
         if response.status_code == 200:
+            routing.observe(task, model, time.perf_counter() - started)
             res = json.loads(response.text)
             msg = {'response':res['result'],'rag_context':res['rag_context']}
+            if cache_key:
+                response_cache.put(cache_key, msg, model=model, system=system, similar_text=near_duplicate)
         else:
             msg = f"Error: Received response code {response.status_code}"
     except requests.exceptions.RequestException as e:
@@ -83,17 +231,104 @@ def generate(
     return msg  
 
 
+def generate_stream(
+    model: str,
+    system: str,
+    query: str,
+    temperature: float | None = None,
+    lastk: int | None = None,
+    session_id: str | None = None,
+    rag_threshold: float | None = 0.5,
+    rag_usage: bool | None = False,
+    rag_k: int | None = 0,
+    task: str | None = None
+    ):
+    """Like generate, but yields the completion text chunk by chunk.
+
+    The proxy streams either server-sent events ("data: {...}" lines) or plain
+    text lines. If it answers with a regular JSON body instead, the whole
+    result is yielded as a single chunk. Errors are yielded as text, the same
+    way generate returns them.
+    """
 
-def upload(multipart_form_data):
+    if task:
+        model = routing.pick(task, model)
+
+    headers = {
+        'x-api-key': api_key,
+        'request_type': 'call'
+    }
+
+    request = {
+        'model': model,
+        'system': system,
+        'query': query,
+        'temperature': temperature,
+        'lastk': lastk,
+        'session_id': session_id,
+        'rag_threshold': rag_threshold,
+        'rag_usage': rag_usage,
+        'rag_k': rag_k,
+        'stream': True
+    }
+
+    with tracing.span("llmproxy.generate_stream", model=model, task=task) as record:
+        started = time.perf_counter()
+        try:
+            with _post(headers=headers, json=request, stream=True) as response:
+                if response.status_code != 200:
+                    record["status"] = "error"
+                    yield f"Error: Received response code {response.status_code}"
+                    return
+
+                if response.headers.get('Content-Type', '').startswith('application/json'):
+                    result = json.loads(response.text)['result']
+                    routing.observe(task, model, time.perf_counter() - started)
+                    yield result
+                    return
+
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line:
+                        continue
+                    if line.startswith('data:'):
+                        line = line[len('data:'):].strip()
+                        if line == '[DONE]':
+                            break
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            yield line
+                            continue
+                        chunk = event.get('chunk', event.get('result', '')) if isinstance(event, dict) else event
+                        if chunk:
+                            yield chunk
+                    else:
+                        yield line + "\n"
+                # Whole-stream duration, comparable with non-streamed calls
+                routing.observe(task, model, time.perf_counter() - started)
+        except requests.exceptions.RequestException as e:
+            record["status"] = "error"
+            yield f"An error occurred: {e}"
+
+
+@tracing.traced("llmproxy.upload", is_error=is_error)
+def upload(multipart_form_data=None, data=None, content_type=None):
+    """Send a document to the proxy, either as requests-style multipart files or
+    as a pre-encoded body (data) with its multipart content_type."""
 
     headers = {
         'x-api-key': api_key,
         'request_type': 'add'
     }
+    if content_type:
+        headers['Content-Type'] = content_type
 
     msg = None
     try:
-        response = requests.post(end_point, headers=headers, files=multipart_form_data)
+        if data is not None:
+            response = _post(session=_get_upload_session(), headers=headers, data=data)
+        else:
+            response = _post(session=_get_upload_session(), headers=headers, files=multipart_form_data)
         
         if response.status_code == 200:
             msg = "Successfully uploaded. It may take a short while for the document to be added to your context"
@@ -105,6 +340,34 @@ def upload(multipart_form_data):
     return msg
 
 
+def _multipart_parts(boundary, params, field, content_type):
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="params"\r\n'
+        f'Content-Type: application/json\r\n\r\n'
+        f'{json.dumps(params)}\r\n'
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    return head, tail
+
+class _SizedBody:
+    """Iterable request body with a known length, so requests sends a
+    Content-Length header instead of falling back to chunked encoding."""
+
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.length
+
+
 def pdf_upload(
     path: str,    
     strategy: str | None = None,
@@ -118,12 +381,13 @@ def pdf_upload(
         'strategy': strategy
     }
 
-    multipart_form_data = {
-        'params': (None, json.dumps(params), 'application/json'),
-        'file': (None, open(path, 'rb'), "application/pdf")
-    }
+    with open(path, 'rb') as f:
+        multipart_form_data = {
+            'params': (None, json.dumps(params), 'application/json'),
+            'file': (None, f, "application/pdf")
+        }
 
-    response = upload(multipart_form_data)
+        response = upload(multipart_form_data)
     return response
 
 def text_upload(
@@ -147,4 +411,41 @@ def text_upload(
 
 
     response = upload(multipart_form_data)
-    return response
\ No newline at end of file
+    return response
+
+def stream_upload(
+    chunks,
+    content_type: str = "application/pdf",
+    length: int | None = None,
+    strategy: str | None = None,
+    description: str | None = None,
+    session_id: str | None = None
+    ):
+    """Upload a document from an iterable of byte chunks (e.g. a download's
+    iter_content) without holding it in memory. PDFs go in the 'file' field and
+    anything else in the 'text' field, like pdf_upload and text_upload. Pass the
+    document's byte length if known; otherwise the body is sent chunked."""
+
+    params = {
+        'description': description,
+        'session_id': session_id,
+        'strategy': strategy
+    }
+
+    field = 'file' if content_type == "application/pdf" else 'text'
+    boundary = uuid.uuid4().hex
+    head, tail = _multipart_parts(boundary, params, field, content_type)
+
+    def body():
+        yield head
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+        yield tail
+
+    data = body()
+    if length is not None:
+        data = _SizedBody(data, len(head) + length + len(tail))
+
+    response = upload(data=data, content_type=f"multipart/form-data; boundary={boundary}")
+    return response
@@ -0,0 +1,188 @@
+"""Optional in-process retrieval over uploaded documents.
+
+Enabled with LOCAL_RAG=1. Needs NumPy; PDFs additionally need pypdf. Text is
+split into overlapping chunks, embedded with signed feature hashing of word
+unigrams and bigrams, and stored per session as a memory-mapped .npy matrix
+next to a JSON list of chunks. query() returns the same
+[{'doc_summary': ..., 'chunks': [...]}] shape as llmproxy.retrieve.
+
+    python local_index.py horror.txt    checks that queries copied from each
+                                        file find it at LOCAL_RAG_THRESHOLD
+"""
+import os
+import re
+import json
+import zlib
+import hashlib
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+ENABLED = os.environ.get("LOCAL_RAG", "0") == "1" and np is not None
+if os.environ.get("LOCAL_RAG", "0") == "1" and np is None:
+    print("LOCAL_RAG is set but NumPy is not installed; using the remote proxy for retrieval")
+
+INDEX_FOLDER = os.path.join("cache", "rag_index")
+DIMENSIONS = int(os.environ.get("LOCAL_RAG_DIMENSIONS", "4096"))
+CHUNK_CHARS = int(os.environ.get("LOCAL_RAG_CHUNK_CHARS", "800"))
+CHUNK_OVERLAP = int(os.environ.get("LOCAL_RAG_CHUNK_OVERLAP", "150"))
+# Minimum cosine score for a chunk. Hashed sparse vectors score far lower than
+# the proxy's embeddings (near-verbatim questions land around 0.1-0.2, unrelated
+# ones under 0.05), so the bots' rag_threshold doesn't apply here
+THRESHOLD = float(os.environ.get("LOCAL_RAG_THRESHOLD", "0.08"))
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its me my "
+    "no not of on or our she so that the their them then there they this to was we "
+    "were what when where which who will with you your".split()
+)
+
+_lock = threading.Lock()
+_loaded = {}   # session_id -> (mtime, vectors, chunks)
+
+def _session_dir(session_id):
+    return os.path.join(INDEX_FOLDER, hashlib.sha1(session_id.encode()).hexdigest())
+
+def _tokens(text):
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOP_WORDS]
+
+def embed(text):
+    """L2-normalized hashed bag of unigrams and bigrams."""
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    tokens = _tokens(text)
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    for feature in features:
+        h = zlib.crc32(feature.encode())
+        vector[h % DIMENSIONS] += 1.0 if h & 0x80000000 else -1.0
+    # Sublinear term frequency keeps repeated words from dominating
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def chunk_text(text):
+    """Split text into ~CHUNK_CHARS pieces on whitespace, overlapping by CHUNK_OVERLAP."""
+    text = re.sub(r"\s+", " ", text).strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + CHUNK_CHARS, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + CHUNK_CHARS // 2, end)
+            end = space if space > start else end
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - CHUNK_OVERLAP, start + 1)
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < end else start
+    return [c for c in chunks if c]
+
+def extract_text(path):
+    """Text of a stored .txt or .pdf upload, or None if it can't be read locally."""
+    if path.lower().endswith(".pdf"):
+        if PdfReader is None:
+            return None
+        reader = PdfReader(path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+def _load(session_id):
+    # Caller holds _lock
+    folder = _session_dir(session_id)
+    vectors_path = os.path.join(folder, "vectors.npy")
+    if not os.path.exists(vectors_path):
+        return None, []
+    mtime = os.path.getmtime(vectors_path)
+    cached = _loaded.get(session_id)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+    vectors = np.load(vectors_path, mmap_mode="r")
+    with open(os.path.join(folder, "chunks.json")) as f:
+        chunks = json.load(f)
+    _loaded[session_id] = (mtime, vectors, chunks)
+    return vectors, chunks
+
+def has_session(session_id):
+    return ENABLED and os.path.exists(os.path.join(_session_dir(session_id), "vectors.npy"))
+
+def add_document(session_id, text, summary):
+    """Chunk, embed and append a document to the session's index. Returns the chunk count."""
+    pieces = chunk_text(text)
+    if not pieces:
+        return 0
+    new_vectors = np.vstack([embed(piece) for piece in pieces])
+    new_chunks = [{"summary": summary, "text": piece} for piece in pieces]
+
+    folder = _session_dir(session_id)
+    os.makedirs(folder, exist_ok=True)
+    with _lock:
+        vectors, chunks = _load(session_id)
+        if vectors is not None:
+            new_vectors = np.vstack([np.asarray(vectors), new_vectors])
+            new_chunks = chunks + new_chunks
+        # Write side files first, then swap them in so readers never see a partial index
+        np.save(os.path.join(folder, "vectors.tmp.npy"), new_vectors)
+        with open(os.path.join(folder, "chunks.tmp.json"), "w") as f:
+            json.dump(new_chunks, f)
+        os.replace(os.path.join(folder, "chunks.tmp.json"), os.path.join(folder, "chunks.json"))
+        os.replace(os.path.join(folder, "vectors.tmp.npy"), os.path.join(folder, "vectors.npy"))
+        _loaded.pop(session_id, None)
+    return len(pieces)
+
+def query(
+    query: str,
+    session_id: str,
+    rag_k: int,
+    rag_threshold: float | None = None
+    ):
+    """Top rag_k chunks scoring at least rag_threshold (default THRESHOLD), grouped by document."""
+    if rag_threshold is None:
+        rag_threshold = THRESHOLD
+    with _lock:
+        vectors, chunks = _load(session_id)
+    if vectors is None or not rag_k:
+        return []
+
+    scores = np.asarray(vectors) @ embed(query)
+    k = min(rag_k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+
+    documents = {}
+    for i in top:
+        if scores[i] < rag_threshold:
+            break
+        chunk = chunks[i]
+        documents.setdefault(chunk["summary"], []).append(chunk["text"])
+    return [{"doc_summary": summary, "chunks": texts} for summary, texts in documents.items()]
+
+if __name__ == "__main__":
+    # Index each file into a scratch session, then query it with sentences
+    # copied from the file; each must find the file it came from
+    import sys
+    import tempfile
+    if np is None:
+        sys.exit("NumPy is not installed")
+    INDEX_FOLDER = tempfile.mkdtemp()
+    failures = 0
+    for path in sys.argv[1:]:
+        text = extract_text(path)
+        name = os.path.basename(path)
+        add_document("selfcheck", text, summary=name)
+        sentences = [s.strip() for s in re.split(r"[.!?\n]", text) if len(_tokens(s)) >= 3]
+        for sentence in sentences[::max(1, len(sentences) // 10)]:
+            found = [doc["doc_summary"] for doc in query(sentence, "selfcheck", rag_k=3)]
+            if name not in found:
+                failures += 1
+                print(f"MISS {name}: {sentence[:60]!r}")
+        print(f"{name}: checked {len(sentences[::max(1, len(sentences) // 10)])} queries")
+    sys.exit(1 if failures else 0)
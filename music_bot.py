@@ -1,44 +1,145 @@
-import requests
 from flask import Flask, request, jsonify
-from llmproxy import generate
+from llmproxy import generate, generate_stream, is_error, response_text
+import tracing
+import resilience
+from jobqueue import enqueue_reply, BUSY_TEXT
+from rocketchat import stream_reply, update_message, send_direct_many
+from fanout import submit, gather
+from search import search_many
+import session_store
+import conversation
+import prompts
 import os
-import random
+import re
+import json
 
 app = Flask(__name__)
+tracing.install(app)
 
-ID_VAL = random.randint(1,100000)
+# Post the recommendation early and edit it as tokens arrive instead of waiting for the full answer
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "0") == "1"
 
-def google_search(query):
-    """Queries Google Search API and returns the first result link."""
-    search_url = "https://www.googleapis.com/customsearch/v1"
-    
-    params = {
-        "key": os.environ.get("GOOGLE_API_KEY"),
-        "cx": os.environ.get("GOOGLE_CSE_ID"),
-        "q": query,
-        "num": 1  # Might change this
-    }
-    
-    response = requests.get(search_url, params=params)
-    
-    if response.status_code == 200:
-        search_results = response.json().get("items", [])
-        if search_results:
-            return search_results[0]["link"]  # Return only the first result
-    print(f"Error: {response.status_code}, {response.text}")
-    return None
+# Answer webhooks immediately and deliver replies through the Rocket.Chat API
+ASYNC_REPLIES = os.environ.get("ASYNC_REPLIES", "0") == "1"
 
-@app.route('/', methods=['POST'])
-def handle_request():
-    global ID_VAL
-    data = request.get_json() 
+# "combined" asks for question, songs and recipient in one JSON call;
+# "separate" makes one call per field
+EXTRACTION_MODE = os.environ.get("MUSIC_EXTRACTION_MODE", "combined")
+
+NO_SONG = "$$no song$$"
+NO_RECIPIENT = "no recipient"
+
+def extract_question(recommendation_text, session_id):
+    """The main question the assistant is asking about the scene."""
+    question_extraction = generate(
+        model='4o-mini',
+        task="extract",
+        system=prompts.text("music_question"),
+        query=prompts.render("music_question_query", recommendation_text=recommendation_text),
+        temperature=0.0,
+        lastk=0,
+        session_id=session_id
+    )
+    return response_text(question_extraction) or ""
+
+def extract_songs(recommendation_text, session_id):
+    """List of "song - artist" strings, or [NO_SONG] if none were recommended."""
+    extraction = generate(
+        model='4o-mini',
+        task="extract",
+        system=prompts.text("music_songs"),
+        query=prompts.render("music_songs_query", recommendation_text=recommendation_text),
+        temperature=0.0,
+        lastk=0,
+        session_id=session_id
+    )
+    text = response_text(extraction)
+    if text is None:
+        return [NO_SONG]
+    return text.split("///")
+
+def extract_recipient(message, session_id):
+    """First and last name to share recommendations with, or NO_RECIPIENT."""
+    recipient_extraction = generate(
+        model='4o-mini',
+        task="extract",
+        system=prompts.text("music_recipient"),
+        query=prompts.render("music_recipient_query", message=message),
+        temperature=0.0,
+        lastk=0,
+        session_id=session_id
+    )
+    return response_text(recipient_extraction) or NO_RECIPIENT
+
+def split_recipients(recipient):
+    """Distinct names in a recipient string such as "Ada Lovelace, Alan Turing and Grace Hopper"."""
+    names = [name.strip() for name in re.split(r",|;|&|\band\b", recipient) if name.strip()]
+    return list(dict.fromkeys(names))
+
+def to_username(name):
+    """Rocket Chat username for a name: "First Last" -> "first.last"."""
+    if " " in name:
+        firstname, lastname = name.split(" ", 1)
+        return f"{firstname.lower()}.{lastname.lower()}"
+    # If only one name is provided, use it as is
+    return name.lower()
+
+def parse_extraction(text):
+    """Strictly parse the combined extraction JSON. Returns None unless it is an
+    object with exactly a string "question", a list of strings "songs" and a
+    string or null "recipient"."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[len("json"):]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or set(data) != {"question", "songs", "recipient"}:
+        return None
+    if not isinstance(data["question"], str):
+        return None
+    if not isinstance(data["songs"], list) or not all(isinstance(song, str) and song.strip() for song in data["songs"]):
+        return None
+    if data["recipient"] is not None and not (isinstance(data["recipient"], str) and data["recipient"].strip()):
+        return None
+    return data
+
+def extract_combined(recommendation_text, message, session_id):
+    """Question, songs and recipient from one structured call, in the same form
+    as the per-field extractors. Returns None if the output doesn't validate."""
+    response = generate(
+        model='4o-mini',
+        task="extract",
+        system=prompts.text("music_extract"),
+        query=prompts.render("music_extract_query", recommendation_text=recommendation_text, message=message),
+        temperature=0.0,
+        lastk=0,
+        session_id=session_id
+    )
+    if not isinstance(response, dict):
+        return None
+    data = parse_extraction(response['response'])
+    if data is None:
+        print(f"Combined extraction failed to parse, falling back: {response['response']!r}")
+        return None
+    return (
+        data["question"],
+        data["songs"] or [NO_SONG],
+        data["recipient"].strip() if data["recipient"] else NO_RECIPIENT
+    )
 
+def build_reply(data):
+    """Build the reply for one Rocket.Chat webhook payload."""
     # Extract relevant information
     user = data.get("user_name", "Unknown")
     second_agent = user + "_2"
     third_agent = user + "_3"
     examples_agent = user + "_examples"
     message = data.get("text", "")
+    room_id = data.get("channel_id", "")
 
     print(data)
 
@@ -47,137 +148,104 @@ def handle_request():
         # Generate examples based on the last question from the bot
         examples_response = generate(
             model='4o-mini',
-            system=(
-                "You are a helpful assistant that provides concrete examples based on questions. "
-                "When given a question, provide 3-4 realistic and varied examples based on the previous conversation "
-                "of how someone might answer that question. Keep each example brief. "
-                "Format each example with a bullet point."
-            ),
-            query=f"The user was asked to describe the vibe of their movie scene or to provide details about mood, lighting, etc. "
-                 f"Generate 3-4  examples of possible answers to the question being posed. "
-                 f"and showcase various film genres and moods.",
+            task="converse",
+            system=prompts.text("music_examples"),
+            query=prompts.text("music_examples_query"),
             temperature=0.7,  # Higher temperature for more creative examples
             lastk=0,
-            session_id=examples_agent + f"_{ID_VAL}"
+            session_id=examples_agent + f"_{session_store.get_generation(user)}"
         )
         
-        examples_text = examples_response["response"]
-        return jsonify({"text": f"Here are some examples of how you could describe your scene:\n\n{examples_text}"})
+        examples_text = response_text(examples_response)
+        if examples_text is None:
+            return {"text": resilience.DEGRADED_TEXT}
+        return {"text": f"Here are some examples of how you could describe your scene:\n\n{examples_text}"}
     
     if message == "restart":
-        ID_VAL = random.randint(1,100000)
-        # Clear session
-        return jsonify({
+        # Start a fresh conversation for this user only
+        session_store.reset(user)
+        return {
             "text": "Let's start over! Please describe the vibe of your movie scene."
-        })
+        }
 
     # Ignore bot messages
     if data.get("bot") or not message:
-        return jsonify({"status": "ignored"})
+        return {"status": "ignored"}
 
     print(f"Message from {user} : {message}")
     
+    session_suffix = f"_{session_store.get_generation(user)}"
+
+    # In separate mode the recipient extraction only depends on the user
+    # message, so it runs while the main recommendation is being generated
+    recipient_future = None
+    if EXTRACTION_MODE != "combined":
+        recipient_future = submit(extract_recipient, message, user + "_recipient" + session_suffix)
+    
     # Generate a response using LLMProxy
-    response = generate(
+    # History is kept per bot, since the router serves every persona from one process
+    history_key = f"music:{user}{session_suffix}"
+    query, lastk = conversation.prepare(history_key, f"query: {message}", lastk=10)
+    main_call = dict(
         model='4o-mini',
-        system='You are an assistant to help movie makers determine what song \
-        to put in their movie scene. If the question is unrelated to this topic \
-        politely remind the user of your purpose. If it appears the user \
-        has an ambiguous prompt or a greeting, greet the user and explain \
-        your purpose. The user will provide a vibe for a scene and you will \
-        help them determine what song to use. \
-        You have 2 options:\
-        #Option 1#\
-        If you do not yet have a compelling song: \
-        Ask questions that should be straight to the point \
-        do not give examples of the answer unless they ask. Ask questions related to the \
-        intended mood, lighting, length of scene etc, one by one so that the \
-        user starts building an idea of what they want or have in mind.\
-        after they go through a series of questions not more than 5 questions, ask them if they have anything else \
-        they want to add and if not, ask them how many songs they want. \
-        Do not provide more than 10 song recommendations. \
-        #Option 2#\
-        Once you have sufficient answers to your questions to make a ecommendation \
-        and if you are confident in your answer, provide the song and artist. \
-        After you provide songs \
-        ask if they like them or if they want to change something. \
-        If you are providing song recommendations, ask who they want to share these recommendations with \
-        by requesting their first and last name.',
-        query= f"query: {message}",
+        task="converse",
+        system=prompts.text("music_recommend"),
+        query=query,
         temperature=0.0,
-        lastk=10,
-        session_id=user+ f"_{ID_VAL}"
+        lastk=lastk,
+        session_id=user + session_suffix
     )
     
-    recommendation_text = response["response"]
-    
-    # Extract the question being asked to use for examples later
-    question_extraction = generate(
-        model='4o-mini',
-        system=(
-            "You are helping identify questions in text. Extract only the most recent question "
-            "that the assistant is asking the user about their movie scene. If there are multiple "
-            "questions, focus on the main one related to describing the scene, mood, lighting, etc."
-        ),
-        query=f"Extract the main question from this text: {recommendation_text}",
-        temperature=0.0,
-        lastk=0,
-        session_id=third_agent+ f"_{ID_VAL}"
-    )
-    
-    current_question = question_extraction['response']
-    
-    # Gets the song and artist so it can be searched
-    extraction = generate(
-        model='4o-mini',
-        system=(
-            "You are helping a second agent. Extract only the song and artist from the provided text. \
-             Remove everything that is not the key song and artist. \
-             If none are found, respond only with '$$no song$$'."
-        ),
-        query=f"Extract song and artist from: {recommendation_text}.\
-                Remove everything that is not the a song and artist pair.\
-                If there are multiple song and artist pairs, separate the \
-                responses with \'///\'. If not songs are found, respond only\
-                with '$$no song$$'",
-        temperature=0.0,
-        lastk=0,
-        session_id=second_agent+ f"_{ID_VAL}"
-    )
+    streamed_message = None
+    if STREAM_REPLIES and room_id:
+        recommendation_text, streamed_message = stream_reply(room_id, generate_stream(**main_call))
+        if is_error(recommendation_text):
+            recommendation_text = None
+    else:
+        recommendation_text = response_text(generate(**main_call))
 
-    song_artists = extraction['response']
-    song_artists = song_artists.split("///")
+    # Model unreachable: reply right away and skip extraction and song lookups
+    if recommendation_text is None:
+        if recipient_future is not None:
+            recipient_future.cancel()
+        if streamed_message:
+            update_message(streamed_message["rid"], streamed_message["_id"], resilience.DEGRADED_TEXT)
+            return {"status": "streamed"}
+        return {"text": resilience.DEGRADED_TEXT}
+    conversation.record(history_key, message, recommendation_text)
     
-    # Extract recipient name if present
-    recipient_extraction = generate(
-        model='4o-mini',
-        system=(
-            "You are helping extract recipient information. If the text contains a question about "
-            "who to share recommendations with and a response with a first and last name, extract "
-            "that name. If no name is found, respond with 'no recipient'."
-        ),
-        query=f"Extract recipient name from: {message}. If there's a first and last name mentioned as "
-              f"someone to share recommendations with, extract it. Otherwise respond with 'no recipient'.",
-        temperature=0.0,
-        lastk=0,
-        session_id=user + "_recipient" + f"_{ID_VAL}"
-    )
-    
-    recipient = recipient_extraction['response']
+    # Pull the question, songs and recipient out of this turn, in one structured
+    # call if possible and otherwise with one call per field
+    extracted = None
+    if EXTRACTION_MODE == "combined":
+        extracted = extract_combined(recommendation_text, message, user + "_extract" + session_suffix)
+    if extracted is None and resilience.is_open("llmproxy"):
+        # Don't queue up per-field calls that would be refused anyway
+        extracted = ("", [NO_SONG], NO_RECIPIENT)
+    if extracted is None:
+        if recipient_future is None:
+            recipient_future = submit(extract_recipient, message, user + "_recipient" + session_suffix)
+        # Extract the question being asked to use for examples later
+        question_future = submit(extract_question, recommendation_text, third_agent + session_suffix)
+        # Gets the song and artist so it can be searched
+        songs_future = submit(extract_songs, recommendation_text, second_agent + session_suffix)
+        extracted = gather(question_future, songs_future, recipient_future)
+
+    current_question, song_artists, recipient = extracted
     
     # Boolean to keep track of things
     is_first = True
     
     # Search for URL only if a song is found
-    if "$$no song$$" in song_artists[0].lower():
+    if NO_SONG in song_artists[0].lower():
         final_response = f"{recommendation_text}"
     else:
         message_items = ""
-        # Search for each song
-        for song_artist in song_artists:
+        # Look up every song at once (cached lookups return immediately)
+        urls = search_many(song_artists)
+        for song_artist, url in zip(song_artists, urls):
             # If first start the chain
             if is_first:
-                url = google_search(song_artist)
                 if url:
                     final_response = f"{recommendation_text}\n\n{song_artist}: {url}"
                     message_items += f"{song_artist}: {url}"
@@ -186,7 +254,6 @@ def handle_request():
                     message_items += f"{song_artist}: (No link)"
                 is_first = False 
             else:
-                url = google_search(song_artist)
                 if url:
                     final_response += f"\n\n{song_artist}: {url}"
                     message_items += f"\n\n{song_artist}: {url}"
@@ -195,41 +262,16 @@ def handle_request():
                     message_items += f"\n\n{song_artist}: (No link)"
         
         # Only send to Rocket Chat if recipient is provided
-        if recipient != "no recipient":
-            # Format recipient for Rocket Chat (convert to username format)
-            if " " in recipient:
-                firstname, lastname = recipient.split(" ", 1)
-                recipient_username = f"@{firstname.lower()}.{lastname.lower()}"
-            else:
-                # If only one name is provided, use it as is
-                recipient_username = f"@{recipient.lower()}"
-            
-            # API endpoint
-            endpoint = "https://chat.genaiconnect.net/api/v1/chat.postMessage"
-            # Headers with authentication tokens
-            headers = {
-                "Content-Type": "application/json",
-                "X-Auth-Token": os.environ.get("RC_token"),
-                "X-User-Id": os.environ.get("RC_userId")
-            }
-            # Payload (data to be sent)
-            payload = {
-                "channel": recipient_username,
-                "text": f"What do you think of these songs for your scene with {user}?\n\n" + message_items
-            }
-            
-            # Sending the POST request
-            response = requests.post(endpoint, json=payload, headers=headers)
-            
-            # Check if the message was sent successfully
-            if response.status_code == 200:
-                final_response += f"\n\nRecommendations sent to {recipient}!"
-            else:
-                final_response += f"\n\nCould not send recommendations to {recipient}. User may not exist in Rocket Chat."
-            
-            # Print response status and content
-            print(response.status_code)
-            print(response.json())
+        if recipient != NO_RECIPIENT:
+            names = split_recipients(recipient)
+            text = f"What do you think of these songs for your scene with {user}?\n\n" + message_items
+            # DM rooms are resolved once and cached; every recipient is sent to at once
+            sent = send_direct_many([to_username(name) for name in names], text)
+            for name in names:
+                if sent[to_username(name)]:
+                    final_response += f"\n\nRecommendations sent to {name}!"
+                else:
+                    final_response += f"\n\nCould not send recommendations to {name}. User may not exist in Rocket Chat."
     
     # Add examples/restart buttons to the response
     response_with_buttons = {
@@ -258,8 +300,24 @@ def handle_request():
     }
     
     print(f"Final Response: {final_response}")
-    return jsonify(response_with_buttons)
+
+    if streamed_message:
+        update_message(streamed_message["rid"], streamed_message["_id"],
+                       final_response, response_with_buttons["attachments"])
+        return {"status": "streamed"}
+
+    return response_with_buttons
     
+@app.route('/', methods=['POST'])
+def handle_request():
+    data = request.get_json()
+    # Acknowledge right away and post the answer from a background worker
+    if ASYNC_REPLIES and data.get("channel_id") and not data.get("bot"):
+        if not enqueue_reply(build_reply, data):
+            return jsonify({"text": BUSY_TEXT})
+        return jsonify({"status": "queued"})
+    return jsonify(build_reply(data))
+
 @app.errorhandler(404)
 def page_not_found(e):
     return "Not Found", 404
@@ -0,0 +1,97 @@
+import os
+import re
+import hashlib
+from string import Template
+import tracing
+from rag_context import estimate_tokens
+
+# Prompt templates, one <name>.txt per prompt, loaded once at import. Each
+# line is stripped and its runs of whitespace collapsed, so the files can be
+# written for readability without the extra spaces reaching the model; line
+# breaks are kept. Templates use string.Template placeholders ($name).
+PROMPT_DIR = os.environ.get(
+    "PROMPT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_templates")
+)
+
+class Prompt:
+    """A normalized template with its stable hash and estimated token count.
+    The hash stands in for the text in response cache keys (see key())."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.sha = hashlib.sha256(text.encode()).hexdigest()[:16]
+        self.tokens = estimate_tokens(text)
+        # Split once into literal text and field names so render() is a single join
+        self._parts = []
+        self.fields = []
+        position = 0
+        for match in Template.pattern.finditer(text):
+            self._parts.append((text[position:match.start()], None))
+            if match.group("escaped") is not None:
+                self._parts.append(("$", None))
+            elif match.group("invalid") is not None:
+                # A lone "$" (e.g. a price) is left as written
+                self._parts.append(("$", None))
+            else:
+                field = match.group("named") or match.group("braced")
+                self._parts.append(("", field))
+                self.fields.append(field)
+            position = match.end()
+        self._parts.append((text[position:], None))
+
+    def render(self, **values):
+        """Substitute every $field, like string.Template.substitute."""
+        return "".join(literal if field is None else str(values[field]) for literal, field in self._parts)
+
+def normalize(text):
+    lines = [re.sub(r"\s+", " ", line).strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+_registry = {}
+_hashes = {}    # normalized text -> hash, for key()
+
+def load(directory=PROMPT_DIR):
+    """(Re)load every template in directory into the registry."""
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        if ext != ".txt":
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            prompt = _registry[name] = Prompt(name, normalize(f.read()))
+        _hashes[prompt.text] = prompt.sha
+
+def get(name):
+    """The registered Prompt called name."""
+    return _registry[name]
+
+def text(name):
+    """The normalized text of a prompt, e.g. for a system prompt."""
+    return _registry[name].text
+
+def key(text):
+    """Stable hash of a prompt text: the precomputed hash of a registered
+    template, otherwise a fresh hash of the text itself."""
+    sha = _hashes.get(text)
+    if sha is None:
+        sha = hashlib.sha256(text.encode()).hexdigest()[:16]
+    return sha
+
+def render(name, **values):
+    """Fill a prompt's placeholders."""
+    return _registry[name].render(**values)
+
+def stats():
+    """Estimated token count of every template, to keep per-call overhead in view."""
+    result = {f"{name}_tokens": prompt.tokens for name, prompt in _registry.items()}
+    result["templates"] = len(_registry)
+    result["tokens_total"] = sum(prompt.tokens for prompt in _registry.values())
+    return result
+
+load()
+tracing.register_stats("prompts", stats)
+
+if __name__ == "__main__":
+    # Print the registry: name, hash and estimated tokens per template
+    for name, prompt in sorted(_registry.items()):
+        print(f"{name:<24} {prompt.sha}  {prompt.tokens:>5} tokens")
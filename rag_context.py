@@ -0,0 +1,110 @@
+import os
+import re
+import threading
+import tracing
+
+# Rough prompt budget for retrieved context, per model (in tokens). Setting
+# RAG_CONTEXT_TOKENS replaces the table with one budget for every model.
+MODEL_TOKEN_BUDGETS = {
+    "4o-mini": 2000
+}
+DEFAULT_TOKEN_BUDGET = 1500
+if os.environ.get("RAG_CONTEXT_TOKENS"):
+    MODEL_TOKEN_BUDGETS = {}
+    DEFAULT_TOKEN_BUDGET = int(os.environ["RAG_CONTEXT_TOKENS"])
+# Chunks whose word 3-gram overlap with an already kept chunk reaches this are dropped
+DUPLICATE_SIMILARITY = float(os.environ.get("RAG_DUPLICATE_SIMILARITY", "0.8"))
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "tokens_in": 0, "tokens_out": 0, "chunks_deduplicated": 0, "chunks_dropped": 0}
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return (len(text) + 3) // 4
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+def _near_duplicate(shingles, kept):
+    for other in kept:
+        overlap = len(shingles & other)
+        # Containment covers a short chunk that sits inside a longer overlapping one
+        if overlap / min(len(shingles), len(other)) >= DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+def build_context(
+    rag_context,
+    model: str | None = None,
+    token_budget: int | None = None,
+    header: str = "",
+    doc_format: str = "\n#{i}: {summary}\n",
+    chunk_format: str = "- {chunk}\n"
+    ):
+    """Format retrieved documents for a prompt: drop near-duplicate chunks, keep
+    the best-ranked ones that fit the model's token budget, and join once.
+
+    Chunks are ranked by their position within their document first, so every
+    document's top chunk is kept before any document's second one.
+    """
+    if not isinstance(rag_context, list) or not rag_context:
+        return ""
+    if token_budget is None:
+        token_budget = MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+    candidates = []
+    tokens_in = 0
+    for d, doc in enumerate(rag_context):
+        tokens_in += estimate_tokens(doc['doc_summary'])
+        for c, chunk in enumerate(doc['chunks']):
+            tokens_in += estimate_tokens(chunk)
+            candidates.append((c, d, chunk))
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1]))
+
+    kept = {}
+    kept_shingles = []
+    used = {}
+    deduplicated = dropped = 0
+    budget = token_budget - estimate_tokens(header)
+    for c, d, chunk in candidates:
+        shingles = _shingles(chunk)
+        if _near_duplicate(shingles, kept_shingles):
+            deduplicated += 1
+            continue
+        cost = estimate_tokens(chunk) + 2
+        if d not in used:
+            cost += estimate_tokens(rag_context[d]['doc_summary']) + 2
+        if cost > budget:
+            dropped += 1
+            continue
+        budget -= cost
+        used[d] = True
+        kept_shingles.append(shingles)
+        kept.setdefault(d, []).append(chunk)
+
+    parts = [header] if kept and header else []
+    for i, d in enumerate(sorted(kept), 1):
+        parts.append(doc_format.format(i=i, summary=rag_context[d]['doc_summary']))
+        for j, chunk in enumerate(kept[d], 1):
+            parts.append(chunk_format.format(i=i, j=j, chunk=chunk))
+    context = "".join(parts)
+
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["tokens_in"] += tokens_in
+        _stats["tokens_out"] += estimate_tokens(context)
+        _stats["chunks_deduplicated"] += deduplicated
+        _stats["chunks_dropped"] += dropped
+    return context
+
+def stats():
+    """Totals across calls, including how many prompt tokens were saved."""
+    with _stats_lock:
+        result = dict(_stats)
+    result["tokens_saved"] = max(result["tokens_in"] - result["tokens_out"], 0)
+    return result
+
+tracing.register_stats("rag_context", stats)
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+import requests
+import tracing
+
+# Per-endpoint request rate (per second) and burst size. The buckets are per
+# process, so with several gunicorn workers each gets its own allowance.
+RATE_LIMITS = {
+    "llmproxy": (float(os.environ.get("LLMPROXY_RATE_LIMIT", "20")),
+                 int(os.environ.get("LLMPROXY_RATE_BURST", "40"))),
+    # The burst covers one music turn's song list (up to 10 link lookups at once)
+    "google": (float(os.environ.get("GOOGLE_RATE_LIMIT", "2")),
+               int(os.environ.get("GOOGLE_RATE_BURST", "10"))),
+    "rocketchat": (float(os.environ.get("RC_RATE_LIMIT", "5")),
+                   int(os.environ.get("RC_RATE_BURST", "10")))
+}
+# Longest a call waits for a token before giving up
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "2"))
+# Consecutive failures that open an endpoint's circuit, and how long it stays open
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", "5"))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "30"))
+
+DEGRADED_TEXT = "Sorry, I can't reach the assistant right now. Please try again in a minute."
+
+class Unavailable(requests.exceptions.RequestException):
+    """Raised instead of sending a request when the endpoint is rate limited or
+    its circuit is open. It is a RequestException, so existing error handling
+    treats it like any other failed request."""
+
+_lock = threading.Lock()
+_buckets = {}   # endpoint -> [tokens, last_refill]
+_circuits = {}  # endpoint -> {"failures", "opened_at", "probing"}
+_stats = {}
+
+def _count(name):
+    # Caller holds _lock
+    _stats[name] = _stats.get(name, 0) + 1
+
+def _circuit(endpoint):
+    circuit = _circuits.get(endpoint)
+    if circuit is None:
+        circuit = _circuits[endpoint] = {"failures": 0, "opened_at": None, "probing": False}
+    return circuit
+
+def _reserve_token(endpoint, now):
+    """Take a token, returning how long to wait for it, or None if that is
+    longer than RATE_LIMIT_MAX_WAIT. Caller holds _lock."""
+    rate, burst = RATE_LIMITS.get(endpoint, (0, 0))
+    if rate <= 0:
+        return 0.0
+    bucket = _buckets.get(endpoint)
+    if bucket is None:
+        bucket = _buckets[endpoint] = [float(burst), now]
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    # Tokens may go negative: each waiting caller owns one future token
+    wait = (1 - bucket[0]) / rate if bucket[0] < 1 else 0.0
+    if wait > RATE_LIMIT_MAX_WAIT:
+        return None
+    bucket[0] -= 1
+    return wait
+
+def acquire(endpoint):
+    """Wait for permission to call endpoint. Raises Unavailable if its circuit
+    is open or the rate limit can't be met within RATE_LIMIT_MAX_WAIT."""
+    now = time.monotonic()
+    with _lock:
+        circuit = _circuit(endpoint)
+        if circuit["opened_at"] is not None:
+            # After the cooldown a single probe call decides whether to close it
+            if now - circuit["opened_at"] < CIRCUIT_COOLDOWN or circuit["probing"]:
+                _count(f"{endpoint}_rejected")
+                raise Unavailable(f"{endpoint} unavailable (circuit open)")
+            circuit["probing"] = True
+        wait = _reserve_token(endpoint, now)
+        if wait is None:
+            circuit["probing"] = False
+            _count(f"{endpoint}_throttled")
+            raise Unavailable(f"{endpoint} unavailable (rate limited)")
+    if wait:
+        time.sleep(wait)
+
+def record(endpoint, ok):
+    """Report the outcome of a call that acquire() allowed."""
+    with _lock:
+        circuit = _circuit(endpoint)
+        circuit["probing"] = False
+        if ok:
+            circuit["failures"] = 0
+            circuit["opened_at"] = None
+            return
+        circuit["failures"] += 1
+        _count(f"{endpoint}_failures")
+        if circuit["opened_at"] is not None or circuit["failures"] >= CIRCUIT_FAILURES:
+            if circuit["opened_at"] is None:
+                print(f"Circuit for {endpoint} opened after {circuit['failures']} failures")
+            circuit["opened_at"] = time.monotonic()
+
+def is_failure(response):
+    """Whether an HTTP response means the endpoint is struggling (throttling or server errors)."""
+    return response.status_code == 429 or response.status_code >= 500
+
+def send(endpoint, fn, *args, **kwargs):
+    """Call fn(*args, **kwargs), a requests call, under endpoint's rate limit
+    and circuit breaker. Raises Unavailable without calling fn when refused."""
+    acquire(endpoint)
+    try:
+        response = fn(*args, **kwargs)
+    except Exception:
+        record(endpoint, False)
+        raise
+    record(endpoint, not is_failure(response))
+    return response
+
+def is_open(endpoint):
+    """Whether calls to endpoint are currently being refused."""
+    with _lock:
+        circuit = _circuits.get(endpoint)
+        return bool(circuit and circuit["opened_at"] is not None
+                    and time.monotonic() - circuit["opened_at"] < CIRCUIT_COOLDOWN)
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        for endpoint, circuit in _circuits.items():
+            result[f"{endpoint}_open"] = int(circuit["opened_at"] is not None)
+    return result
+
+tracing.register_stats("resilience", stats)
@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import closing
+import prompts
+import tracing
+
+# Cache for deterministic, history-free generate calls
+MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1000"))
+TTL = int(os.environ.get("LLM_CACHE_TTL", str(24 * 3600)))
+# Optional SQLite file shared by all workers; empty keeps the cache in memory only
+DISK_PATH = os.environ.get("LLM_CACHE_PATH", "")
+# Jaccard similarity (0-1) above which a near-duplicate counts as a hit; 0 disables.
+# Only calls that pass similar_text (the variable part of their query) take part.
+SIMILARITY = float(os.environ.get("LLM_CACHE_SIMILARITY", "0"))
+# Words that flip a question's meaning; texts differing in one never match
+NEGATIONS = frozenset(["not", "no", "never", "without", "isn", "aren", "don", "doesn", "didn", "cannot", "wasn", "weren"])
+
+_lock = threading.Lock()
+_entries = OrderedDict()   # key -> (created, value)
+_buckets = {}              # (model, system) -> {key: token set}, for near-duplicate lookup
+_stats = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0}
+_disk_initialized = False
+
+def make_key(model, system, query, **params):
+    """Stable hash of everything that determines the completion. The system
+    prompt is represented by its prompt registry hash."""
+    raw = json.dumps([model, prompts.key(system or ""), query, params], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _tokens(text):
+    return frozenset(re.findall(r"[a-z0-9]+", text.lower()))
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    if (a ^ b) & NEGATIONS:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def _connect():
+    global _disk_initialized
+    conn = sqlite3.connect(DISK_PATH, timeout=10)
+    if not _disk_initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)"
+        )
+        conn.commit()
+        _disk_initialized = True
+    return conn
+
+def _disk_get(key):
+    now = time.time()
+    with closing(_connect()) as conn, conn:
+        row = conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > TTL:
+            return None
+        conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+    return row[1], json.loads(row[0])
+
+def _disk_put(key, value, created):
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), created, created)
+        )
+        conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (MAX_ENTRIES,)
+        )
+
+def _forget(key):
+    # Caller holds _lock. Drops the key from the near-duplicate buckets too,
+    # so they never hold keys the LRU can no longer evict
+    _entries.pop(key, None)
+    for bucket_key, bucket in list(_buckets.items()):
+        if bucket.pop(key, None) is not None and not bucket:
+            del _buckets[bucket_key]
+
+def _remember(key, created, value):
+    # Caller holds _lock
+    _entries[key] = (created, value)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _forget(next(iter(_entries)))
+
+def _get_exact(key, now):
+    # Caller holds _lock
+    entry = _entries.get(key)
+    if entry is None:
+        return None
+    if now - entry[0] > TTL:
+        _forget(key)
+        return None
+    _entries.move_to_end(key)
+    return entry[1]
+
+def get(key, model=None, system=None, similar_text=None):
+    """Return the cached value for key, or None. If similar_text is given and
+    near-duplicate matching is on, an entry stored with a similar enough
+    similar_text for the same model and system prompt also counts."""
+    now = time.time()
+    with _lock:
+        value = _get_exact(key, now)
+        if value is not None:
+            _stats["hits"] += 1
+            return value
+
+    if DISK_PATH:
+        try:
+            found = _disk_get(key)
+        except sqlite3.Error as e:
+            print(f"LLM cache error: {e}")
+            found = None
+        if found is not None:
+            with _lock:
+                _remember(key, found[0], found[1])
+                _stats["hits"] += 1
+            return found[1]
+
+    with _lock:
+        if SIMILARITY > 0 and similar_text is not None:
+            tokens = _tokens(similar_text)
+            best_key, best_score = None, SIMILARITY
+            for other_key, other_tokens in list(_buckets.get((model, system), {}).items()):
+                if now - _entries[other_key][0] > TTL:
+                    # An expired entry must not shadow a valid, slightly less similar one
+                    _forget(other_key)
+                    continue
+                score = _jaccard(tokens, other_tokens)
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key is not None:
+                value = _get_exact(best_key, now)
+                if value is not None:
+                    _stats["near_hits"] += 1
+                    return value
+        _stats["misses"] += 1
+    return None
+
+def put(key, value, model=None, system=None, similar_text=None):
+    """Store a successful result, matchable by similar_text if given."""
+    created = time.time()
+    with _lock:
+        _remember(key, created, value)
+        if SIMILARITY > 0 and similar_text is not None:
+            _buckets.setdefault((model, system), {})[key] = _tokens(similar_text)
+        _stats["stores"] += 1
+    if DISK_PATH:
+        try:
+            _disk_put(key, value, created)
+        except sqlite3.Error as e:
+            print(f"LLM cache error: {e}")
+
+def stats():
+    """Hit/miss counters and the hit ratio for this process."""
+    with _lock:
+        result = dict(_stats)
+        result["entries"] = len(_entries)
+    lookups = result["hits"] + result["near_hits"] + result["misses"]
+    result["hit_ratio"] = (result["hits"] + result["near_hits"]) / lookups if lookups else 0.0
+    return result
+
+tracing.register_stats("llm_cache", stats)
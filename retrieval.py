@@ -0,0 +1,176 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+import llmproxy
+import local_index
+from fanout import submit
+import tracing
+
+# Per-session cache in front of llmproxy.retrieve. The cache lives in each
+# process; only upload times are shared between workers (see STORE_PATH).
+TTL = int(os.environ.get("RAG_CACHE_TTL", "600"))
+# Empty results are kept briefly since a fresh upload may still be indexing
+EMPTY_TTL = int(os.environ.get("RAG_CACHE_EMPTY_TTL", "30"))
+# The proxy indexes uploads in the background, so for this long after an
+# upload every result gets EMPTY_TTL in case it is missing the new document
+UPLOAD_GRACE = int(os.environ.get("RAG_UPLOAD_GRACE", "120"))
+MAX_PER_SESSION = int(os.environ.get("RAG_CACHE_MAX_PER_SESSION", "50"))
+MAX_SESSIONS = int(os.environ.get("RAG_CACHE_MAX_SESSIONS", "1000"))
+# Set to share upload times between gunicorn workers via SQLite, so an upload
+# handled by one worker also expires the results cached by the others
+STORE_PATH = os.environ.get("RAG_CACHE_STORE_PATH", "")
+
+_lock = threading.Lock()
+_sessions = OrderedDict()   # session_id -> OrderedDict(key -> (fetched_at, result))
+_uploads = OrderedDict()    # session_id -> time of its last upload, without STORE_PATH
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_db_initialized = False
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", query.lower())).strip()
+
+def _connect():
+    global _db_initialized
+    conn = sqlite3.connect(STORE_PATH, timeout=10)
+    if not _db_initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS uploads (session_id TEXT PRIMARY KEY, uploaded_at REAL)")
+        conn.commit()
+        _db_initialized = True
+    return conn
+
+def _uploaded_at(session_id):
+    """Time of the session's last upload, or 0 if none is recent enough to matter."""
+    if not STORE_PATH:
+        with _lock:
+            return _uploads.get(session_id, 0.0)
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT uploaded_at FROM uploads WHERE session_id = ?", (session_id,)).fetchone()
+    except sqlite3.Error as e:
+        print(f"Retrieval store error: {e}")
+        return 0.0
+    return row[0] if row else 0.0
+
+def _record_upload(session_id, now):
+    if not STORE_PATH:
+        with _lock:
+            _uploads[session_id] = now
+            _uploads.move_to_end(session_id)
+            # Older uploads can no longer outdate a cached entry
+            while next(iter(_uploads.values())) < now - max(TTL, UPLOAD_GRACE):
+                _uploads.popitem(last=False)
+        return
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO uploads (session_id, uploaded_at) VALUES (?, ?)", (session_id, now))
+            # Older uploads can no longer outdate a cached entry
+            conn.execute("DELETE FROM uploads WHERE uploaded_at < ?", (now - max(TTL, UPLOAD_GRACE),))
+    except sqlite3.Error as e:
+        print(f"Retrieval store error: {e}")
+
+def _get(session_id, key, now, uploaded_at):
+    # Caller holds _lock
+    entries = _sessions.get(session_id)
+    if entries is None:
+        return None
+    _sessions.move_to_end(session_id)
+    entry = entries.get(key)
+    if entry is None:
+        return None
+    fetched_at, result = entry
+    ttl = TTL if result and fetched_at >= uploaded_at + UPLOAD_GRACE else EMPTY_TTL
+    if fetched_at < uploaded_at or fetched_at + ttl < now:
+        del entries[key]
+        return None
+    entries.move_to_end(key)
+    return result
+
+def _put(session_id, key, result, now):
+    # Caller holds _lock
+    entries = _sessions.setdefault(session_id, OrderedDict())
+    _sessions.move_to_end(session_id)
+    entries[key] = (now, result)
+    while len(entries) > MAX_PER_SESSION:
+        entries.popitem(last=False)
+    while len(_sessions) > MAX_SESSIONS:
+        _sessions.popitem(last=False)
+
+def retrieve(
+    query: str,
+    session_id: str,
+    rag_threshold: float,
+    rag_k: int
+    ):
+    """llmproxy.retrieve with a per-session cache. Error strings are never cached.
+    Sessions with a local index (LOCAL_RAG=1) also get its matches, merged
+    after the proxy's, so documents the proxy is still indexing are found."""
+    result = _retrieve_remote(query, session_id, rag_threshold, rag_k)
+    if not local_index.has_session(session_id):
+        return result
+    # The local index has its own score scale, so it uses LOCAL_RAG_THRESHOLD
+    local = local_index.query(query=query, session_id=session_id, rag_k=rag_k)
+    if not isinstance(result, list):
+        return local or result
+    return merge(result, local)
+
+def merge(remote, local):
+    """Proxy documents followed by local chunks the proxy didn't return."""
+    seen = {chunk for document in remote for chunk in document.get("chunks", [])}
+    merged = list(remote)
+    for document in local:
+        chunks = [chunk for chunk in document["chunks"] if chunk not in seen]
+        if chunks:
+            merged.append({"doc_summary": document["doc_summary"], "chunks": chunks})
+    return merged
+
+def _retrieve_remote(query, session_id, rag_threshold, rag_k):
+    key = (normalize_query(query), rag_threshold, rag_k)
+    uploaded_at = _uploaded_at(session_id)
+    with _lock:
+        cached = _get(session_id, key, time.time(), uploaded_at)
+        if cached is not None:
+            _stats["hits"] += 1
+            return cached
+        _stats["misses"] += 1
+
+    # Stamped with the start time so an upload during the call outdates it
+    started = time.time()
+    result = llmproxy.retrieve(query=query, session_id=session_id,
+                               rag_threshold=rag_threshold, rag_k=rag_k)
+    if isinstance(result, list):
+        with _lock:
+            _put(session_id, key, result, started)
+    return result
+
+def prefetch(
+    query: str,
+    session_id: str,
+    rag_threshold: float,
+    rag_k: int
+    ):
+    """Start a (cached) retrieval in the background and return its future."""
+    return submit(retrieve, query=query, session_id=session_id,
+                  rag_threshold=rag_threshold, rag_k=rag_k)
+
+def invalidate(session_id):
+    """Forget cached results for a session after it uploads a document, and
+    keep new ones only briefly for UPLOAD_GRACE seconds while the proxy indexes it."""
+    with _lock:
+        if _sessions.pop(session_id, None) is not None:
+            _stats["invalidations"] += 1
+    _record_upload(session_id, time.time())
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["sessions"] = len(_sessions)
+    lookups = result["hits"] + result["misses"]
+    result["hit_ratio"] = result["hits"] / lookups if lookups else 0.0
+    return result
+
+tracing.register_stats("retrieval_cache", stats)
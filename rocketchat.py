@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fanout
+import resilience
+import tracing
+
+# Rocket.Chat credentials
+ROCKET_CHAT_URL = os.environ.get("RC_URL", "https://chat.genaiconnect.net")
+ROCKET_USER_ID = os.environ.get("RCuser", os.environ.get("RC_userId"))
+ROCKET_AUTH_TOKEN = os.environ.get("RCtoken", os.environ.get("RC_token"))
+
+REQUEST_TIMEOUT = float(os.environ.get("RC_TIMEOUT", "10"))
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", "0.75"))
+POOL_SIZE = int(os.environ.get("RC_POOL_SIZE", "10"))
+# Retries for 429 responses only; Retry-After is honoured up to MAX_RETRY_AFTER seconds
+MAX_RETRIES = int(os.environ.get("RC_MAX_RETRIES", "3"))
+MAX_RETRY_AFTER = float(os.environ.get("RC_MAX_RETRY_AFTER", "10"))
+# How long username -> DM room lookups are remembered (failed lookups for less)
+ROOM_CACHE_TTL = int(os.environ.get("RC_ROOM_CACHE_TTL", str(24 * 3600)))
+ROOM_CACHE_NEGATIVE_TTL = int(os.environ.get("RC_ROOM_CACHE_NEGATIVE_TTL", "300"))
+ROOM_CACHE_MAX_ENTRIES = int(os.environ.get("RC_ROOM_CACHE_MAX_ENTRIES", "5000"))
+
+class _CappedRetry(Retry):
+    """Retry that waits as long as Retry-After asks, but never more than MAX_RETRY_AFTER."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+def _make_session():
+    # Only 429s are retried: the request was refused rather than processed, so
+    # retrying a postMessage can't post it twice
+    retry = _CappedRetry(
+        total=MAX_RETRIES,
+        connect=0,
+        read=0,
+        status=MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429,),
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_session = _make_session()
+
+_rooms_lock = threading.Lock()
+_rooms = OrderedDict()  # username -> (room id or None, expires_at)
+_room_stats = {"hits": 0, "misses": 0}
+
+def _headers():
+    return {
+        "Content-Type": "application/json",
+        "X-Auth-Token": ROCKET_AUTH_TOKEN,
+        "X-User-Id": ROCKET_USER_ID
+    }
+
+def _api_post(method, payload):
+    """POST to the Rocket.Chat REST API. Returns the JSON body, or None on failure."""
+    with tracing.span(f"rocketchat.{method}") as record:
+        try:
+            response = resilience.send(
+                "rocketchat",
+                _session.post,
+                f"{ROCKET_CHAT_URL}/api/v1/{method}",
+                json=payload,
+                headers=_headers(),
+                timeout=REQUEST_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Rocket.Chat {method} error: {e}")
+            record["status"] = "error"
+            return None
+        record.update(status_code=response.status_code, bytes_out=len(response.request.body or b""),
+                      bytes_in=len(response.content))
+        if response.status_code != 200:
+            print(f"Rocket.Chat {method} error: {response.status_code}, {response.text}")
+            record["status"] = "error"
+            return None
+        return response.json()
+
+@tracing.traced("rocketchat.download", is_error=lambda response: response is None)
+def open_download(file_id, filename):
+    """Start a streaming download of an uploaded file. Returns the response, or None."""
+    file_url = f"{ROCKET_CHAT_URL}/file-upload/{file_id}/{filename}"
+    headers = {
+        "X-User-Id": ROCKET_USER_ID,
+        "X-Auth-Token": ROCKET_AUTH_TOKEN
+    }
+    try:
+        response = resilience.send("rocketchat", _session.get, file_url, headers=headers,
+                                   stream=True, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print(f"Download error {filename} - {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Download error {filename} - {response.status_code}")
+        response.close()
+        return None
+    return response
+
+def post_message(channel, text, attachments=None):
+    """Post a message to a room id, #channel or @username. Returns the message dict."""
+    payload = {"channel": channel, "text": text}
+    if channel and not channel.startswith(("#", "@")):
+        payload = {"roomId": channel, "text": text}
+    if attachments:
+        payload["attachments"] = attachments
+    result = _api_post("chat.postMessage", payload)
+    return result.get("message") if result else None
+
+def update_message(room_id, msg_id, text, attachments=None):
+    """Replace the text of a message the bot posted earlier."""
+    payload = {"roomId": room_id, "msgId": msg_id, "text": text}
+    if attachments:
+        payload["attachments"] = attachments
+    return _api_post("chat.update", payload) is not None
+
+def direct_room(username):
+    """Room id of the bot's DM with username (with or without a leading @), or
+    None if the user doesn't exist. Lookups are cached for ROOM_CACHE_TTL."""
+    username = username.lstrip("@").lower()
+    now = time.time()
+    with _rooms_lock:
+        cached = _rooms.get(username)
+        if cached is not None and cached[1] > now:
+            _rooms.move_to_end(username)
+            _room_stats["hits"] += 1
+            return cached[0]
+        _room_stats["misses"] += 1
+
+    result = _api_post("im.create", {"username": username})
+    room = result.get("room") if result else None
+    room_id = (room.get("rid") or room.get("_id")) if room else None
+    ttl = ROOM_CACHE_TTL if room_id else ROOM_CACHE_NEGATIVE_TTL
+    with _rooms_lock:
+        _rooms[username] = (room_id, now + ttl)
+        _rooms.move_to_end(username)
+        while len(_rooms) > ROOM_CACHE_MAX_ENTRIES:
+            _rooms.popitem(last=False)
+    return room_id
+
+def send_direct(username, text, attachments=None):
+    """Send a direct message to username. Returns True if it was posted."""
+    room_id = direct_room(username)
+    if room_id is None:
+        return False
+    return post_message(room_id, text, attachments) is not None
+
+def send_direct_many(usernames, text, attachments=None):
+    """Send the same direct message to several users at once. Returns
+    {username: posted} in the order given."""
+    futures = [fanout.submit(send_direct, username, text, attachments) for username in usernames]
+    return dict(zip(usernames, fanout.gather(*futures)))
+
+def stats():
+    with _rooms_lock:
+        result = {f"room_cache_{name}": value for name, value in _room_stats.items()}
+        result["room_cache_entries"] = len(_rooms)
+    return result
+
+def stream_reply(room_id, chunks, interval: float = STREAM_UPDATE_INTERVAL):
+    """Post the first chunk as a new message and keep editing it as more arrive.
+
+    Returns (full_text, message) where message is None if posting failed; the
+    chunks are still fully consumed so the caller always gets the whole text.
+    """
+    text = ""
+    message = None
+    last_update = 0.0
+    dirty = False
+    for chunk in chunks:
+        text += chunk
+        dirty = True
+        if message is None:
+            if text.strip():
+                message = post_message(room_id, text)
+                last_update = time.monotonic()
+                dirty = False
+        elif time.monotonic() - last_update >= interval:
+            update_message(message["rid"], message["_id"], text)
+            last_update = time.monotonic()
+            dirty = False
+    if message is not None and dirty:
+        update_message(message["rid"], message["_id"], text)
+    return text, message
+
+tracing.register_stats("rocketchat", stats)
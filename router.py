@@ -0,0 +1,41 @@
+import os
+import importlib
+from flask import Flask, request, jsonify
+import tracing
+
+# Serves every persona from one process so they share the HTTP pools, caches
+# and worker pools. Each bot is mounted at /<name>; POSTs to / are dispatched
+# on the Rocket.Chat outgoing-webhook token, falling back to DEFAULT_BOT.
+#   ROUTER_BOTS="ta=TA_bot,music=music_bot"          bots to mount (name=module)
+#   ROUTER_TOKENS="<token>=ta,<other token>=music"    webhook token -> bot name
+BOTS = {"app": "app", "ta": "TA_bot", "ta2": "TA_bot2", "music": "music_bot"}
+if os.environ.get("ROUTER_BOTS"):
+    BOTS = dict(item.split("=", 1) for item in os.environ["ROUTER_BOTS"].split(","))
+TOKENS = dict(item.split("=", 1) for item in os.environ.get("ROUTER_TOKENS", "").split(",") if item)
+DEFAULT_BOT = os.environ.get("ROUTER_DEFAULT_BOT", "app")
+
+app = Flask(__name__)
+tracing.install(app)
+
+# Each bot's own webhook view; they read flask.request, so they work as-is
+# inside this app's request context
+_handlers = {}
+for name, module in BOTS.items():
+    _handlers[name] = importlib.import_module(module).handle_request
+    app.add_url_rule(f"/{name}", endpoint=name, view_func=_handlers[name], methods=["POST"])
+
+@app.route("/", methods=["POST"])
+def dispatch():
+    data = request.get_json(silent=True) or {}
+    name = TOKENS.get(data.get("token"), DEFAULT_BOT)
+    handler = _handlers.get(name)
+    if handler is None:
+        return jsonify({"status": "unknown bot"}), 404
+    return handler()
+
+@app.errorhandler(404)
+def page_not_found(e):
+    return "Not Found", 404
+
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,107 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+import tracing
+
+# Picks the model for each generate call from its task class. Every route has
+# a primary model, an optional fallback and a p95 latency budget; when the
+# primary's recent p95 goes over budget, calls switch to the fallback for
+# ROUTE_COOLDOWN seconds and then try the primary again with fresh samples.
+#   ROUTE_<TASK>_MODEL     primary model (default: the model the call site names)
+#   ROUTE_<TASK>_FALLBACK  alternate model (default: none, so no switching)
+#   ROUTE_<TASK>_SLO_MS    p95 latency budget in milliseconds
+TASKS = {"classify": 1500, "extract": 3000, "converse": 8000}
+WINDOW = int(os.environ.get("ROUTE_WINDOW", "100"))
+MIN_SAMPLES = int(os.environ.get("ROUTE_MIN_SAMPLES", "20"))
+COOLDOWN = float(os.environ.get("ROUTE_COOLDOWN", "300"))
+
+def _route_config(task, slo_ms):
+    prefix = f"ROUTE_{task.upper()}"
+    return {
+        "model": os.environ.get(f"{prefix}_MODEL") or None,
+        "fallback": os.environ.get(f"{prefix}_FALLBACK") or None,
+        "slo": float(os.environ.get(f"{prefix}_SLO_MS", str(slo_ms))) / 1000
+    }
+
+ROUTES = {task: _route_config(task, slo_ms) for task, slo_ms in TASKS.items()}
+
+_lock = threading.Lock()
+_latencies = {}     # (task, model) -> deque of recent durations in seconds
+_fallback_until = {}  # task -> monotonic time the route goes back to its primary
+_stats = {}
+
+def _count(name):
+    # Caller holds _lock
+    _stats[name] = _stats.get(name, 0) + 1
+
+def _p95(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+def pick(task, default_model):
+    """Model to use for a call of this task class."""
+    route = ROUTES.get(task)
+    if route is None:
+        return default_model
+    primary = route["model"] or default_model
+    fallback = route["fallback"]
+    if not fallback:
+        return primary
+
+    now = time.monotonic()
+    with _lock:
+        until = _fallback_until.get(task)
+        if until is not None:
+            if now < until:
+                _count(f"{task}_fallback_calls")
+                return fallback
+            # Cooldown over: judge the primary on new samples only
+            del _fallback_until[task]
+            _latencies.pop((task, primary), None)
+            print(f"Model route {task} back on {primary}")
+
+        samples = _latencies.get((task, primary))
+        if samples and len(samples) >= MIN_SAMPLES and _p95(samples) > route["slo"]:
+            _fallback_until[task] = now + COOLDOWN
+            _count(f"{task}_fallbacks")
+            _count(f"{task}_fallback_calls")
+            print(f"Model route {task}: p95 {_p95(samples) * 1000:.0f} ms over "
+                  f"{route['slo'] * 1000:.0f} ms on {primary}, using {fallback}")
+            return fallback
+    return primary
+
+def observe(task, model, duration):
+    """Record how long an upstream call for this route took."""
+    if task not in ROUTES:
+        return
+    with _lock:
+        samples = _latencies.get((task, model))
+        if samples is None:
+            samples = _latencies[(task, model)] = deque(maxlen=WINDOW)
+        samples.append(duration)
+        _count(f"{task}_calls")
+        if duration > ROUTES[task]["slo"]:
+            _count(f"{task}_over_slo")
+
+def p95(task, model):
+    """Recent p95 latency (seconds) of a route's model, or None without samples."""
+    with _lock:
+        samples = _latencies.get((task, model))
+        return _p95(samples) if samples else None
+
+def stats():
+    now = time.monotonic()
+    with _lock:
+        result = dict(_stats)
+        for (task, model), samples in _latencies.items():
+            if samples:
+                # Model names like "4o-mini" aren't valid in metric names
+                name = re.sub(r"\W", "_", model)
+                result[f"{task}_{name}_p95_ms"] = round(_p95(samples) * 1000, 1)
+        for task in ROUTES:
+            result[f"{task}_on_fallback"] = int(_fallback_until.get(task, 0) > now)
+    return result
+
+tracing.register_stats("routing", stats)
@@ -0,0 +1,219 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+import contextvars
+import requests
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import resilience
+import singleflight
+import tracing
+
+SEARCH_URL = os.environ.get("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "10"))
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", "5"))
+
+CACHE_FOLDER = "cache"
+CACHE_PATH = os.environ.get("SEARCH_CACHE_PATH", os.path.join(CACHE_FOLDER, "search.sqlite3"))
+CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+# Custom Search requests allowed per day across all workers (0 = unlimited)
+DAILY_QUOTA = int(os.environ.get("GOOGLE_DAILY_QUOTA", "100"))
+os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+
+_session = requests.Session()
+_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+_init_lock = threading.Lock()
+_initialized = False
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "errors": 0, "over_quota": 0}
+
+def normalize_query(query):
+    """Lowercase and strip punctuation so "Song – Artist" and "song - artist" share a key."""
+    query = query.lower()
+    query = re.sub(r"[‐-―]", "-", query)
+    query = re.sub(r"[\"'`‘’“”*]", "", query)
+    query = re.sub(r"\s*-\s*", " - ", query)
+    query = re.sub(r"[?!.,;:]+(\s|$)", r"\1", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+def cache_key(query, site_filter=None):
+    """Cache key for a query plus its site filter."""
+    return f"{normalize_query(query)}|{site_filter or ''}"
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def _connect():
+    global _initialized
+    conn = sqlite3.connect(CACHE_PATH, timeout=10)
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                # WAL lets several gunicorn workers read while one writes
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS search_cache ("
+                    "key TEXT PRIMARY KEY, link TEXT, created REAL, last_used REAL)"
+                )
+                conn.execute("CREATE TABLE IF NOT EXISTS search_quota (day TEXT PRIMARY KEY, used INTEGER)")
+                conn.commit()
+                _initialized = True
+    return conn
+
+def cache_get(key):
+    """Return the cached link for key ('' if Google had no result), or None on a miss."""
+    now = time.time()
+    with closing(_connect()) as conn, conn:
+        row = conn.execute(
+            "SELECT link, created FROM search_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > CACHE_TTL:
+            conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+    return row[0]
+
+def cache_put(key, link):
+    now = time.time()
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO search_cache (key, link, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, link or "", now, now)
+        )
+        # Evict the least recently used entries once over capacity
+        conn.execute(
+            "DELETE FROM search_cache WHERE key IN ("
+            "SELECT key FROM search_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ENTRIES,)
+        )
+
+def take_quota():
+    """Count one request against today's quota (UTC days, shared through the
+    cache database). Returns False once the quota is used up."""
+    if DAILY_QUOTA <= 0:
+        return True
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO search_quota (day, used) VALUES (?, 0)", (day,))
+        updated = conn.execute(
+            "UPDATE search_quota SET used = used + 1 WHERE day = ? AND used < ?", (day, DAILY_QUOTA)
+        ).rowcount
+        conn.execute("DELETE FROM search_quota WHERE day < ?", (day,))
+    return updated == 1
+
+def refund_quota():
+    """Give back a request taken with take_quota() that was never sent."""
+    if DAILY_QUOTA <= 0:
+        return
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    with closing(_connect()) as conn, conn:
+        conn.execute("UPDATE search_quota SET used = used - 1 WHERE day = ? AND used > 0", (day,))
+
+def cache_size():
+    with closing(_connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+def stats():
+    """Hit/miss counters for this process plus the shared cache size."""
+    with _stats_lock:
+        result = dict(_stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_ratio"] = result["hits"] / lookups if lookups else 0.0
+    try:
+        result["entries"] = cache_size()
+    except sqlite3.Error:
+        result["entries"] = None
+    return result
+
+def _fetch(query, site_filter=None):
+    """Query the Custom Search API. Returns (link, ok) where ok is False on errors."""
+    params = {
+        "key": os.environ.get("GOOGLE_API_KEY"),
+        "cx": os.environ.get("GOOGLE_CSE_ID"),
+        "q": query,
+        "num": 1
+    }
+
+    if site_filter:
+        params["q"] += f" site:{site_filter}"
+    # Don't spend quota on a request the circuit breaker would refuse anyway
+    if resilience.is_open("google"):
+        return None, False
+    try:
+        if not take_quota():
+            _count("over_quota")
+            return None, False
+    except sqlite3.Error as e:
+        print(f"Search quota error: {e}")
+    try:
+        response = resilience.send("google", _session.get, SEARCH_URL, params=params, timeout=SEARCH_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print(f"Search error: {e}")
+        if isinstance(e, resilience.Unavailable):
+            # Refused by the rate limiter or circuit breaker, so Google never saw it
+            try:
+                refund_quota()
+            except sqlite3.Error as db_error:
+                print(f"Search quota error: {db_error}")
+        return None, False
+    tracing.annotate(status_code=response.status_code, bytes_in=len(response.content))
+
+    if response.status_code == 200:
+        search_results = response.json().get("items", [])
+        if search_results:
+            return search_results[0]["link"], True
+        return None, True
+    print(f"Error: {response.status_code}, {response.text}")
+    return None, False
+
+@tracing.traced("google.search")
+def google_search(query, site_filter=None):
+    """Queries Google Search API and returns the first result link, using the cache."""
+    key = cache_key(query, site_filter)
+    try:
+        cached = cache_get(key)
+    except sqlite3.Error as e:
+        print(f"Search cache error: {e}")
+        cached = None
+    if cached is not None:
+        _count("hits")
+        tracing.annotate(cache="hit")
+        return cached or None
+
+    _count("misses")
+    tracing.annotate(cache="miss")
+    # Identical lookups already in flight (e.g. a class asking the same
+    # question at once) wait for that request instead of sending their own
+    link, ok = singleflight.do("search", key, _fetch_and_store, key, query, site_filter)
+    if not ok:
+        tracing.annotate(status="error")
+    return link
+
+def _fetch_and_store(key, query, site_filter):
+    link, ok = _fetch(query, site_filter)
+    if not ok:
+        _count("errors")
+    else:
+        try:
+            cache_put(key, link)
+        except sqlite3.Error as e:
+            print(f"Search cache error: {e}")
+    return link, ok
+
+def search_many(queries, site_filter=None):
+    """Resolve several queries concurrently, returning links in the same order.
+    Each lookup runs in a copy of the caller's context, so its spans keep the request id."""
+    futures = [
+        _executor.submit(contextvars.copy_context().run, google_search, query, site_filter)
+        for query in queries
+    ]
+    return [future.result() for future in futures]
+
+tracing.register_stats("search_cache", stats)
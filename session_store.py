@@ -0,0 +1,111 @@
+import os
+import time
+import uuid
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+import tracing
+
+# Maps each user to their current conversation generation, which is appended
+# to proxy session ids so a restart starts a fresh conversation for that user only.
+# Set SESSION_STORE_PATH to share the store between gunicorn workers via SQLite.
+STORE_PATH = os.environ.get("SESSION_STORE_PATH", "")
+IDLE_TIMEOUT = int(os.environ.get("SESSION_IDLE_TIMEOUT", str(24 * 3600)))
+MAX_SESSIONS = int(os.environ.get("SESSION_MAX_ENTRIES", "10000"))
+
+_lock = threading.Lock()
+_sessions = OrderedDict()   # user -> (generation, last_seen)
+_stats = {"lookups": 0, "created": 0, "resets": 0, "expired": 0}
+_db_initialized = False
+
+def _new_generation():
+    # Random rather than a counter so it can't repeat one from before a restart
+    return uuid.uuid4().hex[:12]
+
+def _connect():
+    global _db_initialized
+    conn = sqlite3.connect(STORE_PATH, timeout=10)
+    if not _db_initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user TEXT PRIMARY KEY, generation TEXT, last_seen REAL)"
+        )
+        conn.commit()
+        _db_initialized = True
+    return conn
+
+def _memory_get(user, now):
+    # Caller holds _lock
+    entry = _sessions.get(user)
+    if entry is not None and now - entry[1] > IDLE_TIMEOUT:
+        _stats["expired"] += 1
+        entry = None
+    if entry is None:
+        _stats["created"] += 1
+        generation = _new_generation()
+    else:
+        generation = entry[0]
+    _sessions[user] = (generation, now)
+    _sessions.move_to_end(user)
+    while len(_sessions) > MAX_SESSIONS:
+        _sessions.popitem(last=False)
+    return generation
+
+def _db_get(user, now):
+    with closing(_connect()) as conn, conn:
+        # Take the write lock before reading, so two workers seeing the same
+        # new user can't each store a different generation
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT generation, last_seen FROM sessions WHERE user = ?", (user,)).fetchone()
+        if row is not None and now - row[1] <= IDLE_TIMEOUT:
+            conn.execute("UPDATE sessions SET last_seen = ? WHERE user = ?", (now, user))
+            return row[0]
+        generation = _new_generation()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (user, generation, last_seen) VALUES (?, ?, ?)",
+            (user, generation, now)
+        )
+        # Drop idle sessions now and then instead of on every write
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM sessions WHERE last_seen < ?", (now - IDLE_TIMEOUT,))
+    with _lock:
+        _stats["expired" if row is not None else "created"] += 1
+    return generation
+
+def get_generation(user):
+    """Current conversation generation for user, starting a new one if the
+    user is unknown or has been idle longer than SESSION_IDLE_TIMEOUT."""
+    now = time.time()
+    with _lock:
+        _stats["lookups"] += 1
+        if not STORE_PATH:
+            return _memory_get(user, now)
+    return _db_get(user, now)
+
+def reset(user):
+    """Start a new conversation for user only. Returns the new generation."""
+    now = time.time()
+    generation = _new_generation()
+    with _lock:
+        _stats["resets"] += 1
+        if not STORE_PATH:
+            _sessions[user] = (generation, now)
+            _sessions.move_to_end(user)
+            return generation
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (user, generation, last_seen) VALUES (?, ?, ?)",
+            (user, generation, now)
+        )
+    return generation
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["sessions"] = len(_sessions)
+    return result
+
+tracing.register_stats("sessions", stats)
@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import Future
+import tracing
+
+# Collapses concurrent identical calls into one: the first caller runs the
+# call and everyone who asks for the same key meanwhile waits for its result.
+
+_lock = threading.Lock()
+_in_flight = {}     # (kind, key) -> Future
+_stats = {}         # "<kind>_calls" / "<kind>_collapsed" -> count
+
+def _count(name):
+    # Caller holds _lock
+    _stats[name] = _stats.get(name, 0) + 1
+
+def do(kind, key, fn, *args, **kwargs):
+    """Return fn(*args, **kwargs), sharing one in-flight call among concurrent
+    callers with the same (kind, key). Exceptions reach every waiting caller."""
+    with _lock:
+        _count(f"{kind}_calls")
+        future = _in_flight.get((kind, key))
+        leader = future is None
+        if leader:
+            future = _in_flight[(kind, key)] = Future()
+        else:
+            _count(f"{kind}_collapsed")
+
+    if not leader:
+        tracing.annotate(coalesced=True)
+        return future.result()
+
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        with _lock:
+            del _in_flight[(kind, key)]
+        future.set_exception(e)
+        raise
+    # Later callers start a fresh call rather than reusing this one
+    with _lock:
+        del _in_flight[(kind, key)]
+    future.set_result(result)
+    return result
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["in_flight"] = len(_in_flight)
+    return result
+
+tracing.register_stats("singleflight", stats)
@@ -0,0 +1,233 @@
+"""Local stand-ins for the LLM proxy, Google Custom Search and Rocket.Chat,
+for trying and benchmarking the bots offline.
+
+    python stub_servers.py --proxy-port 8001 --google-port 8002 --rc-port 8003
+
+then run a bot with endPoint=http://127.0.0.1:8001/,
+GOOGLE_SEARCH_URL=http://127.0.0.1:8002/ and RC_URL=http://127.0.0.1:8003.
+Every stub takes a fixed latency and an error rate, and counts its calls;
+GET /_stats returns the counts and POST /_reset clears them.
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Shared plumbing: latency, random 503s and per-kind call counters."""
+    latency = 0.0
+    error_rate = 0.0
+    counts = None
+    counts_lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    @classmethod
+    def configure(cls, latency=None, error_rate=None):
+        if latency is not None:
+            cls.latency = latency
+        if error_rate is not None:
+            cls.error_rate = error_rate
+        cls.counts = {}
+        cls.counts_lock = threading.Lock()
+
+    def count(self, kind):
+        with self.counts_lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _simulate(self, kind):
+        """Count the call, wait, and maybe fail. Returns False if it answered with an error."""
+        self.count(kind)
+        time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.count("errors")
+            self._send_json({"error": "stubbed failure"}, status=503)
+            return False
+        return True
+
+    def _handle_admin(self):
+        if self.path == "/_stats":
+            with self.counts_lock:
+                self._send_json(dict(self.counts))
+            return True
+        if self.path == "/_reset":
+            with self.counts_lock:
+                self.counts.clear()
+            self._send_json({})
+            return True
+        return False
+
+    def do_GET(self):
+        if not self._handle_admin():
+            self.handle_get()
+
+    def do_POST(self):
+        if not self._handle_admin():
+            self.handle_post()
+
+    def handle_get(self):
+        self._send_json({"error": "not found"}, status=404)
+
+    def handle_post(self):
+        self._send_json({"error": "not found"}, status=404)
+
+class ProxyStubHandler(StubHandler):
+    """Mimics the LLMProxy endpoint: call (optionally streamed), retrieve and add.
+    Replies are canned and picked from the system prompt, so yes/no checks and
+    extraction calls get answers the bots can parse."""
+    latency = 0.2
+    chunk_delay = 0.05
+    # Extra latency per model name, for exercising model routing fallbacks
+    model_latency = {}
+    reply = "This is a stubbed reply from the local LLM proxy. It streams word by word."
+
+    def _reply_for(self, request):
+        system = request.get("system") or ""
+        if "JSON" in system:
+            return json.dumps({
+                "question": "What mood should the scene have?",
+                "songs": ["Clair de Lune - Debussy", "Holocene - Bon Iver"],
+                "recipient": None
+            })
+        if "'yes' or 'no'" in system:
+            return "yes"
+        if "song and artist" in system:
+            return "Clair de Lune - Debussy///Holocene - Bon Iver"
+        if "recipient" in system:
+            return "no recipient"
+        return self.reply
+
+    def handle_post(self):
+        request_type = self.headers.get("request_type")
+        body = self._read_body()
+        if not self._simulate(request_type or "unknown"):
+            return
+
+        if request_type == "retrieve":
+            self._send_json([])
+        elif request_type == "add":
+            self._send_json({"result": "ok"})
+        elif request_type == "call":
+            request = json.loads(body or b"{}")
+            model = request.get("model")
+            self.count(f"model:{model}")
+            time.sleep(self.model_latency.get(model, 0))
+            if request.get("stream"):
+                self._stream(self._reply_for(request))
+            else:
+                self._send_json({"result": self._reply_for(request), "rag_context": []})
+        else:
+            self._send_json({"error": "unknown request_type"}, status=400)
+
+    def _stream(self, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in text.split(" "):
+            event = json.dumps({"chunk": word + " "})
+            self.wfile.write(f"data: {event}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+class GoogleStubHandler(StubHandler):
+    """Mimics the Custom Search JSON API with one YouTube result per query."""
+    latency = 0.15
+
+    def handle_get(self):
+        if not self._simulate("search"):
+            return
+        self._send_json({"items": [{"link": f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"}]})
+
+class RocketChatStubHandler(StubHandler):
+    """Mimics the Rocket.Chat REST calls the bots make and serves file downloads."""
+    latency = 0.05
+    file_body = b"Stub syllabus text. Dijkstra's algorithm finds shortest paths. " * 200
+
+    def handle_get(self):
+        if not self._simulate("download"):
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(self.file_body)))
+        self.end_headers()
+        self.wfile.write(self.file_body)
+
+    def handle_post(self):
+        method = self.path.rsplit("/", 1)[-1]
+        payload = json.loads(self._read_body() or b"{}")
+        if not self._simulate(method):
+            return
+        if method == "chat.postMessage":
+            room = payload.get("roomId") or payload.get("channel")
+            self._send_json({"success": True, "message": {"_id": uuid.uuid4().hex, "rid": room}})
+        elif method == "chat.update":
+            self._send_json({"success": True})
+        elif method == "im.create":
+            username = payload.get("username", "")
+            self._send_json({"success": True, "room": {"_id": f"dm-{username}", "rid": f"dm-{username}", "t": "d"}})
+        else:
+            self._send_json({"success": True})
+
+def start_server(handler, port=0, latency=None, error_rate=None):
+    """Start a stub server on a background thread. Returns the server."""
+    handler.configure(latency, error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--proxy-port", type=int, default=8001)
+    parser.add_argument("--google-port", type=int, default=8002)
+    parser.add_argument("--rc-port", type=int, default=8003)
+    parser.add_argument("--latency", type=float, default=None, help="override every stub's latency (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="extra proxy latency for one model (repeatable)")
+    args = parser.parse_args()
+    for item in args.model_latency:
+        model, seconds = item.split("=", 1)
+        ProxyStubHandler.model_latency[model] = float(seconds)
+
+    servers = [
+        start_server(ProxyStubHandler, args.proxy_port, args.latency, args.error_rate),
+        start_server(GoogleStubHandler, args.google_port, args.latency, args.error_rate),
+        start_server(RocketChatStubHandler, args.rc_port, args.latency, args.error_rate)
+    ]
+    for server in servers:
+        print(f"{server.RequestHandlerClass.__name__} listening on http://127.0.0.1:{server.server_port}/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
@@ -0,0 +1,160 @@
+"""Lightweight spans for the bot pipeline.
+
+Wrap outbound calls in span()/traced() to record duration, status and payload
+sizes per request. Aggregates are exposed in Prometheus text format by the
+/metrics route that install() adds to a Flask app (per worker process), and
+TRACE_JSON_LOGS=1 prints one JSON line per span tagged with the request id.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+
+JSON_LOGS = os.environ.get("TRACE_JSON_LOGS", "0") == "1"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_lock = threading.Lock()
+_spans = {}          # name -> {"buckets": [...], "sum": s, "count": n, "errors": e, "bytes_in": b, "bytes_out": b}
+_stats_sources = {}  # prefix -> function returning a dict of numbers
+
+def new_request(request_id=None):
+    """Start a traced request in the current context and return its id."""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    return request_id
+
+def request_id():
+    return _request_id.get()
+
+def annotate(**attrs):
+    """Attach attributes (status_code, bytes_in, bytes_out, ...) to the innermost span."""
+    record = _current_span.get()
+    if record is not None:
+        record.update(attrs)
+
+def _record(name, duration, record):
+    status = record.get("status", "ok")
+    with _lock:
+        entry = _spans.get(name)
+        if entry is None:
+            entry = _spans[name] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0,
+                                    "errors": 0, "bytes_in": 0, "bytes_out": 0}
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                entry["buckets"][i] += 1
+        entry["sum"] += duration
+        entry["count"] += 1
+        entry["errors"] += status != "ok"
+        entry["bytes_in"] += record.get("bytes_in") or 0
+        entry["bytes_out"] += record.get("bytes_out") or 0
+    if JSON_LOGS:
+        line = {"request_id": _request_id.get(), "span": name, "duration_ms": round(duration * 1000, 2)}
+        line.update(record)
+        print(json.dumps(line, default=str), file=sys.stderr, flush=True)
+
+@contextmanager
+def span(name, **attrs):
+    """Time the enclosed block. Exceptions mark the span as an error."""
+    record = dict(attrs)
+    previous = _current_span.get()
+    _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            record["status"] = "error"
+            record.setdefault("error", repr(e))
+        raise
+    finally:
+        _current_span.set(previous)
+        _record(name, time.perf_counter() - started, record)
+
+def traced(name, is_error=None):
+    """Decorator form of span(). is_error(result) can flag returned errors, for
+    functions that report failures as values rather than exceptions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name) as record:
+                result = fn(*args, **kwargs)
+                if is_error is not None and is_error(result):
+                    record["status"] = "error"
+                return result
+        return wrapper
+    return decorator
+
+def register_stats(prefix, stats_fn):
+    """Expose a module's stats() dict as gauges named bot_<prefix>_<key>."""
+    _stats_sources[prefix] = stats_fn
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def metrics_text():
+    """All spans and registered stats in Prometheus text exposition format."""
+    lines = [
+        "# HELP bot_span_duration_seconds Duration of traced calls.",
+        "# TYPE bot_span_duration_seconds histogram",
+    ]
+    with _lock:
+        spans = {name: dict(entry, buckets=list(entry["buckets"])) for name, entry in _spans.items()}
+    for name, entry in sorted(spans.items()):
+        label = f'span="{_escape(name)}"'
+        for bound, count in zip(BUCKETS, entry["buckets"]):
+            lines.append(f'bot_span_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'bot_span_duration_seconds_bucket{{{label},le="+Inf"}} {entry["count"]}')
+        lines.append(f'bot_span_duration_seconds_sum{{{label}}} {entry["sum"]}')
+        lines.append(f'bot_span_duration_seconds_count{{{label}}} {entry["count"]}')
+    lines += ["# HELP bot_span_errors_total Traced calls that failed.", "# TYPE bot_span_errors_total counter"]
+    lines += [f'bot_span_errors_total{{span="{_escape(name)}"}} {entry["errors"]}' for name, entry in sorted(spans.items())]
+    lines += ["# HELP bot_span_bytes_total Payload bytes sent and received by traced calls.",
+              "# TYPE bot_span_bytes_total counter"]
+    for name, entry in sorted(spans.items()):
+        lines.append(f'bot_span_bytes_total{{span="{_escape(name)}",direction="out"}} {entry["bytes_out"]}')
+        lines.append(f'bot_span_bytes_total{{span="{_escape(name)}",direction="in"}} {entry["bytes_in"]}')
+
+    for prefix, stats_fn in sorted(_stats_sources.items()):
+        try:
+            stats = stats_fn()
+        except Exception as e:
+            print(f"Metrics error for {prefix}: {e!r}")
+            continue
+        for key, value in sorted(stats.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f"bot_{prefix}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+def install(app):
+    """Give a Flask app request ids, per-request span logging and a /metrics route."""
+    from flask import request, g
+
+    @app.before_request
+    def _start_trace():
+        g.trace_started = time.perf_counter()
+        new_request(request.headers.get("X-Request-ID"))
+
+    @app.after_request
+    def _finish_trace(response):
+        response.headers["X-Request-ID"] = request_id() or ""
+        if JSON_LOGS and request.path != "/metrics":
+            duration = time.perf_counter() - g.get("trace_started", time.perf_counter())
+            print(json.dumps({"request_id": request_id(), "span": "http.request", "path": request.path,
+                              "status_code": response.status_code,
+                              "duration_ms": round(duration * 1000, 2)}), file=sys.stderr, flush=True)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    return app